@@ -0,0 +1,17 @@
+﻿//
+// Generative Art Program
+// Copyright (c) 2025 KryKom & ZlomenyMesic
+// Licensed under the MIT License
+// 
+//      founded 11.9.2024
+//
+
+namespace GAP.machineLearning;
+
+/// <summary>
+/// thrown when a python script reports an error or exits before finishing its job
+/// </summary>
+internal class PythonScriptException : Exception {
+    internal PythonScriptException(string message, string? pythonTraceback = null) 
+        : base(pythonTraceback is null ? message : $"{message}\n{pythonTraceback}") { }
+}
\ No newline at end of file
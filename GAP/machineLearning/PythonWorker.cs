@@ -0,0 +1,233 @@
+﻿//
+// Generative Art Program
+// Copyright (c) 2025 KryKom & ZlomenyMesic
+// Licensed under the MIT License
+// 
+//      founded 11.9.2024
+//
+
+using System.Collections.Concurrent;
+using System.Diagnostics;
+using System.Text.Json;
+
+namespace GAP.machineLearning;
+
+/// <summary>
+/// a running python script communicating with the host using the message protocol
+/// described in utils/MessageProtocol.py. each message is a single line of JSON,
+/// the host sends jobs to the script's stdin and the script replies with progress,
+/// result and error messages on its stdout. the messages are read on a background
+/// thread, so the host never has to poll, and when the script exits (or crashes),
+/// all jobs waiting for their results fail immediately
+/// </summary>
+internal sealed class PythonWorker : IDisposable {
+    private readonly Process process;
+    private readonly Thread reader;
+    private readonly object sendLock = new();
+
+    /// <summary>
+    /// jobs waiting for their result, keyed by their id. messages without
+    /// an id (sent by scripts which don't receive any jobs) use an empty id
+    /// </summary>
+    private readonly ConcurrentDictionary<string, PendingJob> jobs = new();
+    private int lastJobId;
+
+    private sealed class PendingJob(Action<JsonElement>? onProgress) {
+        internal readonly TaskCompletionSource<JsonElement> Result = new(TaskCreationOptions.RunContinuationsAsynchronously);
+        internal readonly Action<JsonElement>? OnProgress = onProgress;
+    }
+
+    /// <summary>
+    /// true until the script exits
+    /// </summary>
+    internal bool IsRunning => !process.HasExited;
+
+    /// <summary>
+    /// starts the script, the script MUST be located in machineLearning directory!
+    /// </summary>
+    /// <param name="name">script/file name</param>
+    /// <param name="args">optional arguments</param>
+    /// <exception cref="PythonScriptException">the script could not be started</exception>
+    internal PythonWorker(string name, string args = "") : this(name, args, null) { }
+
+    /// <param name="name">script/file name</param>
+    /// <param name="args">optional arguments</param>
+    /// <param name="scriptJob">job representing the whole script, registered before the script starts</param>
+    private PythonWorker(string name, string args, PendingJob? scriptJob) {
+        if (scriptJob is not null) jobs[""] = scriptJob;
+
+        process = PythonWrapper.StartPythonScript(name, args)
+                  ?? throw new PythonScriptException($"could not run script: {name}");
+
+        reader = new Thread(ReadMessages) { IsBackground = true, Name = $"{name} reader" };
+        reader.Start();
+    }
+
+    /// <summary>
+    /// runs a script which doesn't receive any jobs and only reports its progress
+    /// and result, and waits until it finishes
+    /// </summary>
+    /// <param name="name">script/file name</param>
+    /// <param name="args">optional arguments</param>
+    /// <param name="onProgress">called for each progress message</param>
+    /// <returns>the result message</returns>
+    /// <exception cref="PythonScriptException">the script reported an error or exited without a result</exception>
+    internal static JsonElement RunScript(string name, string args = "", Action<JsonElement>? onProgress = null) {
+        PendingJob job = new(onProgress);
+
+        using PythonWorker worker = new(name, args, job);
+        return job.Result.Task.GetAwaiter().GetResult();
+    }
+
+    /// <summary>
+    /// sends a job to the script
+    /// </summary>
+    /// <param name="parameters">job parameters, serialized as a JSON object</param>
+    /// <param name="onProgress">called (on the reader thread) for each progress and preview message of the job</param>
+    /// <param name="priority">jobs with higher priority are started first (only used by DreamScheduler.py)</param>
+    /// <param name="cancellation">asks the script to cancel the job (only supported by DreamScheduler.py)</param>
+    /// <returns>task completed by the result message, failed by an error message, or cancelled by a cancelled message</returns>
+    internal Task<JsonElement> SubmitJob(object parameters, Action<JsonElement>? onProgress = null, 
+                                         int priority = 0, CancellationToken cancellation = default) {
+        string id = Interlocked.Increment(ref lastJobId).ToString();
+        PendingJob job = new(onProgress);
+        jobs[id] = job;
+
+        Send(new Dictionary<string, object> { ["type"] = "job", ["id"] = id, ["params"] = parameters, ["priority"] = priority });
+
+        // the script might have exited before the job was registered
+        if (!IsRunning) Fail(id, "script exited before the job was finished");
+
+        // the job stays pending until the script confirms the cancellation,
+        // it might still finish (or fail) before the script gets to it
+        if (cancellation.CanBeCanceled) {
+            CancellationTokenRegistration registration = cancellation.Register(
+                () => Send(new Dictionary<string, object> { ["type"] = "cancel", ["id"] = id }));
+            job.Result.Task.ContinueWith(_ => registration.Dispose(), TaskScheduler.Default);
+        }
+
+        return job.Result.Task;
+    }
+
+    /// <summary>
+    /// sends a job to the script and waits for its result
+    /// </summary>
+    /// <exception cref="PythonScriptException">the job failed</exception>
+    internal JsonElement RunJob(object parameters, Action<JsonElement>? onProgress = null) 
+        => SubmitJob(parameters, onProgress).GetAwaiter().GetResult();
+
+    /// <summary>
+    /// sends a single message to the script
+    /// </summary>
+    internal void Send(object message) {
+        lock (sendLock) {
+            try {
+                process.StandardInput.WriteLine(JsonSerializer.Serialize(message));
+                process.StandardInput.Flush();
+            }
+            catch (IOException) {
+                // the script has already exited, the pending jobs fail in ReadMessages()
+            }
+        }
+    }
+
+    /// <summary>
+    /// reads the messages sent by the script until it exits
+    /// </summary>
+    private void ReadMessages() {
+        while (process.StandardOutput.ReadLine() is { } line) {
+            JsonElement message;
+            try {
+                using JsonDocument document = JsonDocument.Parse(line);
+                message = document.RootElement.Clone();
+            }
+            catch (JsonException) {
+                // not a message, just something the script printed
+                Console.WriteLine(line);
+                continue;
+            }
+
+            // valid JSON, but not a message (e.g. a number or a string printed by a library)
+            string? type = message.ValueKind == JsonValueKind.Object ? GetString(message, "type") : null;
+            if (type is null) {
+                Console.WriteLine(line);
+                continue;
+            }
+
+            string id = GetString(message, "id") ?? "";
+
+            PendingJob? job;
+            switch (type) {
+                case "progress":
+                case "preview":
+                    if (jobs.TryGetValue(id, out job)) ReportProgress(job, message, line);
+                    break;
+                case "result":
+                    if (jobs.TryRemove(id, out job)) job.Result.TrySetResult(message);
+                    break;
+                case "cancelled":
+                    if (jobs.TryRemove(id, out job)) job.Result.TrySetCanceled();
+                    break;
+                case "error":
+                    string error = GetString(message, "message") ?? "unknown error";
+                    string? traceback = GetString(message, "traceback");
+
+                    // an error without an id means the whole script failed, an error
+                    // of a job which isn't pending anymore doesn't affect the other jobs
+                    if (id == "") {
+                        foreach (string key in jobs.Keys) Fail(key, error, traceback);
+                    }
+                    else if (!jobs.ContainsKey(id)) {
+                        Console.WriteLine($"error of job {id} which is not pending: {error}");
+                    }
+                    else {
+                        Fail(id, error, traceback);
+                    }
+                    break;
+            }
+        }
+
+        process.WaitForExit();
+        foreach (string key in jobs.Keys) {
+            Fail(key, $"script exited with code {process.ExitCode} before the job was finished");
+        }
+    }
+
+    /// <summary>
+    /// returns the string property of the message, or null when it's missing or not a string
+    /// </summary>
+    private static string? GetString(JsonElement message, string name) 
+        => message.TryGetProperty(name, out JsonElement value) && value.ValueKind == JsonValueKind.String ? value.GetString() : null;
+
+    /// <summary>
+    /// invokes the progress callback of the job. a progress message missing some of the
+    /// expected properties is only printed, it must not stop the reader thread
+    /// </summary>
+    private static void ReportProgress(PendingJob job, JsonElement message, string line) {
+        try {
+            job.OnProgress?.Invoke(message);
+        }
+        catch (Exception e) when (e is InvalidOperationException or KeyNotFoundException or FormatException) {
+            Console.WriteLine($"invalid progress message: {line}");
+        }
+    }
+
+    private void Fail(string id, string message, string? traceback = null) {
+        if (jobs.TryRemove(id, out PendingJob? job))
+            job.Result.TrySetException(new PythonScriptException(message, traceback));
+    }
+
+    /// <summary>
+    /// asks the script to exit and waits for it
+    /// </summary>
+    public void Dispose() {
+        if (IsRunning) {
+            Send(new Dictionary<string, object> { ["type"] = "exit" });
+            process.StandardInput.Close();
+            process.WaitForExit();
+        }
+
+        reader.Join();
+        process.Dispose();
+    }
+}
\ No newline at end of file
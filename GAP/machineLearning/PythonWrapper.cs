@@ -31,6 +31,29 @@ internal static class PythonWrapper {
         }
     }
 
+    /// <summary>
+    /// starts a long-running python script with redirected standard input and output,
+    /// which are then used to communicate with the script while it runs (see PythonWorker).
+    /// the script MUST be located in machineLearning directory!
+    /// </summary>
+    /// <param name="name">script/file name</param>
+    /// <param name="args">optional arguments</param>
+    /// <returns>the started process, or null if it could not be started</returns>
+    internal static Process? StartPythonScript(string name, string args = "") {
+        try {
+            return Process.Start(new ProcessStartInfo() {
+                FileName = PYTHON_CMD,
+                Arguments = $"{SCRIPT_DIR}{name} {args}",
+                RedirectStandardInput = true,
+                RedirectStandardOutput = true,
+                UseShellExecute = false
+            });
+        } catch {
+            Console.WriteLine($"Could not run script: {name}");
+            return null;
+        }
+    }
+
     /// <summary>
     /// executes a command using cmd.exe.
     /// </summary>
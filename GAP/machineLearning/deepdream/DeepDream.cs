@@ -8,7 +8,7 @@
 
 using System.Diagnostics;
 using System.Drawing;
-using System.Text;
+using System.Text.Json;
 using GapCore;
 using GapCore.modLoader;
 using GapCore.util.exceptions;
@@ -34,6 +34,19 @@ namespace GAP.machineLearning.deepdream;
 ///   MaxLoss
 ///   LayerSequence
 ///   LayerActivationFunction
+///   TileSize
+///   TileOverlap
+///   BatchInputs
+///   BatchSize
+///   Checkpoint
+///   CacheDirectory
+///   CacheSize
+///   ProfilePath
+///   Priority
+///   Preview
+///   PreviewEvery
+///   PreviewPath
+///   PreviewKeep
 ///  
 /// HOW TO RUN THE GENERATOR?
 /// use one of the following functions:
@@ -42,6 +55,11 @@ namespace GAP.machineLearning.deepdream;
 ///   RunGeneratorCustom()
 ///   RunGeneratorRandom()
 ///   RunGeneratorFilteredRandom()
+///
+/// when generating more images, call StartWorker() first. the model
+/// is then loaded only once instead of once per generated image. with
+/// StartWorker(workers), several images are generated at the same time
+/// using RunGeneratorAsync()
 ///  
 /// </summary>
 [ExcludeFromModLoading]
@@ -125,6 +143,100 @@ public class DeepDream : IImageGenerator<DeepDream> {
     public int MaxLoss { get; set; } = int.MaxValue;
 
 
+    /// <summary>
+    /// size of the tiles the image is split into when processed. the memory needed
+    /// then depends on the tile size rather than on the image size, which allows
+    /// processing large images. 0 = no tiling, the whole image is processed at once,
+    /// otherwise at least 75 (the smallest input of InceptionV3)
+    /// </summary>
+    public int TileSize { get; set; } = 0;
+
+
+    /// <summary>
+    /// number of pixels shared by two neighbouring tiles. the tiles are blended
+    /// together within the overlap to hide the seams. must be smaller than TileSize
+    /// </summary>
+    public int TileOverlap { get; set; } = 32;
+
+
+    /// <summary>
+    /// origins (of the ImageOriginFormat type) of images processed together in a single
+    /// run. images of the same size share a single pass through the network, which is
+    /// much faster than running them one by one. the outputs are saved next to OutputPath,
+    /// numbered by the order of inputs (e.g. dream_0.png). empty = ImageOrigin is used
+    /// </summary>
+    public string[] BatchInputs { get; set; } = [];
+
+
+    /// <summary>
+    /// maximum number of images processed at once when using BatchInputs
+    /// </summary>
+    public int BatchSize { get; set; } = 8;
+
+
+    /// <summary>
+    /// save the interim result after each layer, so an interrupted run continues
+    /// from the last finished layer instead of starting over. the checkpoint is
+    /// saved next to OutputPath and removed once the final image is saved
+    /// </summary>
+    public bool Checkpoint { get; set; } = false;
+
+
+    /// <summary>
+    /// directory where the downloaded and preprocessed input images are cached, so
+    /// repeated runs with the same input skip downloading, decoding and preprocessing
+    /// of the image. empty = no caching
+    /// </summary>
+    public string CacheDirectory { get; set; } = "";
+
+
+    /// <summary>
+    /// maximum size of the cache in megabytes, the least recently used images are removed first
+    /// </summary>
+    public int CacheSize { get; set; } = 1024;
+
+
+    /// <summary>
+    /// file the timing of each phase (model loading, layers, octaves, iterations, ...)
+    /// is written to as json lines. empty = no profiling
+    /// </summary>
+    public string ProfilePath { get; set; } = "";
+
+
+    /// <summary>
+    /// when several jobs wait for a free worker (see StartWorker(workers)),
+    /// the jobs with higher priority are started first
+    /// </summary>
+    public int Priority { get; set; } = 0;
+
+
+    /// <summary>
+    /// save previews of the image while it's being generated, so a bad choice
+    /// of parameters can be noticed (and the job cancelled) early. see PreviewSaved
+    /// </summary>
+    public bool Preview { get; set; } = false;
+
+
+    /// <summary>
+    /// number of iterations between two previews, 0 = only a preview after each octave
+    /// </summary>
+    public int PreviewEvery { get; set; } = 0;
+
+
+    /// <summary>
+    /// location where the previews are saved, empty = next to the output image
+    /// (e.g. dream.preview.png)
+    /// </summary>
+    public string PreviewPath { get; set; } = "";
+
+
+    /// <summary>
+    /// number of previews kept. when larger than 1, the previews are numbered
+    /// (e.g. dream.preview.0.png) and the oldest one is overwritten
+    /// </summary>
+    public int PreviewKeep { get; set; } = 1;
+
+
     /// <summary>
     /// all 311 layers from the InceptionV3 model
     /// </summary>
@@ -155,9 +267,6 @@ public class DeepDream : IImageGenerator<DeepDream> {
     public object[] LayerSequence { get; set; } = ["mixed0"];
 
 
-    public string FinishCheckPath { get; set; } = @"..\..\..\machineLearning\deepdream\output\DONE";
-
-
     /// <summary>
     /// different possible layer activation functions
     /// any custom function must take the current iteration and total number of layers as arguments
@@ -192,22 +301,115 @@ public class DeepDream : IImageGenerator<DeepDream> {
     public Func<int, int, int> LayerActivationFunction { get; set; } = LayerActivationFunctions.LAST_PRIORITY;
 
 
-    private const string PARAMS_PATH = @"..\..\..\machineLearning\deepdream\params.txt";
     private const string DD_PYTHON_SCRIPT_PATH = @"deepdream\DeepDream.py";
+    private const string DD_SCHEDULER_SCRIPT_PATH = @"deepdream\DreamScheduler.py";
+
+
+    /// <summary>
+    /// progress of the generator, reported after each iteration
+    /// </summary>
+    /// <param name="Layer">number of the current layer (starting from 1)</param>
+    /// <param name="Octave">number of the current octave (starting from 1)</param>
+    /// <param name="Iteration">number of the current iteration (starting from 1)</param>
+    /// <param name="Loss">current loss of each image still being processed</param>
+    public readonly record struct DreamProgress(int Layer, int Octave, int Iteration, float[] Loss);
+
+
+    /// <summary>
+    /// invoked after each iteration of the generator (from a background thread)
+    /// </summary>
+    public event Action<DreamProgress>? ProgressChanged;
+
+
+    /// <summary>
+    /// invoked (from a background thread) with the paths of the saved previews, see Preview
+    /// </summary>
+    public event Action<string[]>? PreviewSaved;
+
+
+    /// <summary>
+    /// long-running python process serving the generator jobs, see StartWorker()
+    /// </summary>
+    private static PythonWorker? WORKER;
+
+
+    /// <summary>
+    /// starts the DeepDream worker. the worker loads the model only once and then keeps
+    /// serving jobs sent by RunGenerator(), so the startup cost of the python script
+    /// (importing TensorFlow and building the model) is only paid for the first image
+    /// </summary>
+    /// <param name="workers">
+    /// number of images generated at the same time, each by its own python process pinned to
+    /// its share of the cores. 0 = decided by the number of cores (see DreamScheduler.py).
+    /// a single worker (1) can't cancel jobs, use StartWorker(workers) with more workers for that
+    /// </param>
+    /// <exception cref="PythonScriptException">the worker could not be started</exception>
+    public static void StartWorker(int workers = 1) {
+        if (WORKER is { IsRunning: true }) return;
+
+        WORKER?.Dispose();
+        WORKER = workers == 1
+            ? new PythonWorker(DD_PYTHON_SCRIPT_PATH, "--worker")
+            : new PythonWorker(DD_SCHEDULER_SCRIPT_PATH, $"--workers {workers}");
+    }
+
+
+    /// <summary>
+    /// stops the DeepDream worker once it finishes the current job
+    /// </summary>
+    public static void StopWorker() {
+        WORKER?.Dispose();
+        WORKER = null;
+    }
 
 
     /// <summary>
-    /// saves the current parameters to params.txt to make them accessible from
-    /// the python script. changing the order also has to be done in DeepDream.py
+    /// creates the job parameters sent to the python script. the keys are
+    /// the same as the parameter names used in DeepDream.py
     /// </summary>
-    private void SaveParameters() {
-        // convert the layer sequence and the respective activations into two single line strings
-        string layers = ArrayToString(LayerSequence);
-        string activations = ArrayToString([..CreateLayerActivationsArray(LayerSequence.Length)]);
+    private Dictionary<string, object> CreateJobParameters() => new() {
+        ["VERBOSE"] = Verbose,
+        ["IMG_NAME"] = ImageName,
+        ["IMG_ORIGIN"] = ImageOrigin,
+        ["IMG_ORIGIN_FORMAT"] = (int)ImageOriginFormat,
+        ["OUTPUT_PATH"] = OutputPath,
+        ["DISTORTION_RATE"] = DistortionRate,
+        ["OCTAVES"] = Octaves,
+        ["OCT_SCALE"] = OctaveScale,
+        ["ITERATIONS"] = Iterations,
+        ["MAX_LOSS"] = MaxLoss,
+        ["LAYERS"] = LayerSequence.Select(l => l.ToString()).ToArray(),
+        ["LAYER_ACTIVATIONS"] = CreateLayerActivationsArray(LayerSequence.Length),
+        ["TILE_SIZE"] = TileSize,
+        ["TILE_OVERLAP"] = TileOverlap,
+        ["BATCH_INPUTS"] = BatchInputs,
+        ["BATCH_SIZE"] = BatchSize,
+        ["CHECKPOINT"] = Checkpoint,
+        ["CACHE_DIR"] = CacheDirectory,
+        ["CACHE_SIZE"] = CacheSize,
+        ["PROFILE"] = ProfilePath,
+        ["PREVIEW"] = Preview,
+        ["PREVIEW_EVERY"] = PreviewEvery,
+        ["PREVIEW_PATH"] = PreviewPath,
+        ["PREVIEW_KEEP"] = PreviewKeep
+    };
+
 
-        // save the parameters to the file
-        using StreamWriter sw = new(PARAMS_PATH);
-        sw.Write($"{Verbose}\n{ImageName}\n{ImageOrigin}\n{ImageOriginFormat}\n{OutputPath}\n{FinishCheckPath}\n{DistortionRate}\n{Octaves}\n{OctaveScale}\n{Iterations}\n{MaxLoss}\n{layers}\n{activations}");
+    /// <summary>
+    /// converts a progress message sent by the python script and invokes ProgressChanged,
+    /// or PreviewSaved in case of a preview message
+    /// </summary>
+    private void ReportProgress(JsonElement message) {
+        if (message.GetProperty("type").GetString() == "preview") {
+            PreviewSaved?.Invoke(message.GetProperty("paths").EnumerateArray().Select(p => p.GetString()!).ToArray());
+            return;
+        }
+
+        ProgressChanged?.Invoke(new DreamProgress(
+            message.GetProperty("layer").GetInt32(),
+            message.GetProperty("octave").GetInt32(),
+            message.GetProperty("iteration").GetInt32(),
+            message.GetProperty("loss").EnumerateArray().Select(l => l.GetSingle()).ToArray()));
     }
 
 
@@ -225,20 +427,6 @@ public class DeepDream : IImageGenerator<DeepDream> {
     }
 
 
-    /// <summary>
-    /// puts all array items separated by spaces into a single line string
-    /// </summary>
-    /// <param name="arr">array to convert</param>
-    /// <returns>single line string</returns>
-    private static string ArrayToString(object[] arr) {
-        StringBuilder sb = new();
-        for (int i = 0; i < arr.Length; i++) {
-            sb.Append($"{(i != 0 ? " " : "")}{arr[i]}");
-        }
-        return sb.ToString();
-    }
-
-
     /// <summary>
     /// removes UGLY_LAYERS from ALL_LAYERS
     /// </summary>
@@ -251,32 +439,23 @@ public class DeepDream : IImageGenerator<DeepDream> {
     }
 
 
-    /// <summary>
-    /// waits for a file called DONE. this file is created by the python
-    /// script after finishing the generation and saving the output image
-    /// </summary>
-    private void WaitForOutput() {
-        while (!File.Exists(FinishCheckPath))
-            Thread.Sleep(500);
-        File.Delete(FinishCheckPath);
-    }
-
-
     /// <summary>
     /// runs the generator with the current layer sequence
     /// </summary>
+    /// <exception cref="PythonScriptException">the python script failed</exception>
     public void RunGenerator() {
         // measure the time spent to generate the image
         Stopwatch timer = new();
         timer.Start();
 
-        // in case of a bug
-        File.Delete(FinishCheckPath);
-
-        SaveParameters();
-
-        PythonWrapper.RunPythonScript(DD_PYTHON_SCRIPT_PATH);
-        WaitForOutput();
+        // use the worker if there is one, otherwise run the script just for this image
+        if (WORKER is { IsRunning: true }) {
+            WORKER.RunJob(CreateJobParameters(), ReportProgress);
+        }
+        else {
+            using PythonWorker worker = new(DD_PYTHON_SCRIPT_PATH, "--worker");
+            worker.RunJob(CreateJobParameters(), ReportProgress);
+        }
 
         // print the time spent
         timer.Stop();
@@ -284,6 +463,25 @@ public class DeepDream : IImageGenerator<DeepDream> {
     }
 
 
+    /// <summary>
+    /// submits the job to the worker without waiting for it. when the worker was started with more
+    /// workers, the submitted jobs run at the same time, and the ones with higher Priority start first
+    /// </summary>
+    /// <param name="cancellation">
+    /// cancels the job, whether it's still waiting or already running. only the scheduler started by
+    /// StartWorker(workers) with workers other than 1 can cancel jobs, a single worker ignores the
+    /// cancellation and the job finishes normally
+    /// </param>
+    /// <returns>task completed once the image is saved to OutputPath</returns>
+    /// <exception cref="InvalidOperationException">the worker is not running, see StartWorker()</exception>
+    public Task RunGeneratorAsync(CancellationToken cancellation = default) {
+        if (WORKER is not { IsRunning: true }) 
+            throw new InvalidOperationException("the worker has to be started first using StartWorker()");
+
+        return WORKER.SubmitJob(CreateJobParameters(), ReportProgress, Priority, cancellation);
+    }
+
+
     /// <summary>
     /// runs the generator with a specified layer sequence
     /// </summary>
@@ -384,7 +582,8 @@ public class DeepDream : IImageGenerator<DeepDream> {
             .Argument("distortion_rate", Arguments.Float(defaultValue: 20))
             .Argument("max_loss", Arguments.Integer(1, defaultValue: int.MaxValue))
             .Argument("layer_sequence", Arguments.SelectionList(ALL_LAYERS))
-            .Argument("finish_check_path", Arguments.String(maxLength: 512, allowNewlines: false))
+            .Argument("tile_size", Arguments.Integer(0, defaultValue: 0))
+            .Argument("tile_overlap", Arguments.Integer(0, defaultValue: 32))
             .Constructs(c => {
                 var d = new DeepDream {
                     Verbose = (bool)c["verbose"].Get(),
@@ -398,7 +597,8 @@ public class DeepDream : IImageGenerator<DeepDream> {
                     DistortionRate = (float)c["distortion_rate"].Get(),
                     MaxLoss = (int)c["max_loss"].Get(),
                     LayerSequence = ((object[])c["layer_sequence"].Get()).ToArray(),
-                    FinishCheckPath = (string)c["finish_check_path"].Get()
+                    TileSize = (int)c["tile_size"].Get(),
+                    TileOverlap = (int)c["tile_overlap"].Get()
                 };
 
                 return d;
@@ -10,18 +10,122 @@ import os
 os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
-import tensorflow as tf
-import tensorflow.keras as keras
-import tensorflow.keras.applications.inception_v3 as inception_v3
-import matplotlib.pyplot as plt
 import numpy as np
+from PIL import Image
 
-import sys, os
+import sys, os, json, time, threading
+from collections import OrderedDict
+from contextlib import nullcontext
 sys.path.append(os.path.relpath(r"..\..\..\machinelearning\utils"))
 from ConsoleColors import *
+import MessageProtocol
+import InputCache
+import Profiler
+import Progress
+
+# id of the currently processed job, progress messages are tagged with it
+JOB_ID = None
+
+# converts a parameter which may either come from params.txt (as a string)
+# or from a worker job (already typed) into the required type
+def parse_bool(value):
+    return value if isinstance(value, bool) else value == "True"
+
+def parse_list(value):
+    return value.split(" ") if isinstance(value, str) else [str(item) for item in value]
+
+# paths may contain spaces, so they are separated by semicolons instead
+def parse_path_list(value):
+    if isinstance(value, str):
+        return [path for path in value.split(";") if path.strip() != ""]
+    return [str(item) for item in value]
+
+# the C# side writes the enum name (e.g. FILE_PATH) instead of its value
+ORIGIN_FORMATS = {"FILE_PATH" : 0, "URL" : 1}
+def parse_origin_format(value):
+    if value in ORIGIN_FORMATS:
+        return ORIGIN_FORMATS[value]
+    return int(value)
+
+# parameters passed in params.txt, in the same order as they are written
+# by DeepDream.cs. worker jobs use the same names as keys
+PARAMS = [
+    ("VERBOSE", parse_bool),
+    ("IMG_NAME", str),
+    ("IMG_ORIGIN", str),
+    ("IMG_ORIGIN_FORMAT", parse_origin_format),
+    ("OUTPUT_PATH", str),
+    ("DONE", str),
+    ("DISTORTION_RATE", float),
+    ("OCTAVES", int),
+    ("OCT_SCALE", float),
+    ("ITERATIONS", int),
+    ("MAX_LOSS", float),
+    ("LAYERS", parse_list),
+    ("LAYER_ACTIVATIONS", parse_list)
+]
 
 # number of parameters passed in params.txt
-PARAMS_LEN = 13
+PARAMS_LEN = len(PARAMS)
+
+# smallest tile InceptionV3 accepts, smaller inputs are too small for its reductions
+MIN_TILE_SIZE = 75
+
+# optional parameters and their default values. in params.txt, they may follow
+# the positional parameters as NAME=value lines, worker jobs may just omit them
+OPTIONAL_PARAMS = [
+    # size of the tiles in pixels, 0 disables tiling (see tiled_gradient_ascent_step)
+    ("TILE_SIZE", int, 0),
+    # number of pixels shared by two neighbouring tiles
+    ("TILE_OVERLAP", int, 32),
+    # image origins processed in batch mode (see run_job), empty disables batching
+    ("BATCH_INPUTS", parse_path_list, []),
+    # maximum number of images processed at once in batch mode
+    ("BATCH_SIZE", int, 8),
+    # save the images to disk after each layer, so an interrupted job can resume
+    ("CHECKPOINT", parse_bool, False),
+    # directory of the input cache (see InputCache.py), empty disables the cache
+    ("CACHE_DIR", str, ""),
+    # maximum size of the input cache in megabytes
+    ("CACHE_SIZE", int, 1024),
+    # directory used instead of downloading the images from URLs (e.g. when offline)
+    ("ORIGIN_MIRROR", str, ""),
+    # file the timing of each phase is written to (see Profiler.py), "-" = stderr
+    ("PROFILE", str, ""),
+    # number of the octave (starting from 1) to capture a TensorFlow profiler trace of
+    ("PROFILE_TRACE_OCTAVE", int, 0),
+    # directory the TensorFlow profiler trace is saved to
+    ("PROFILE_TRACE_DIR", str, "profile"),
+    # save a preview of the images while they are being dreamed on (see queue_preview)
+    ("PREVIEW", parse_bool, False),
+    # number of iterations between two previews, 0 = only after each octave
+    ("PREVIEW_EVERY", int, 0),
+    # file the previews are saved to, empty = next to the output (e.g. dream.preview.png)
+    ("PREVIEW_PATH", str, ""),
+    # number of previews kept, they are numbered and the oldest one gets overwritten
+    ("PREVIEW_KEEP", int, 1)
+]
+
+# returns the value following the given command line argument
+def get_argument(name, default = ""):
+    return sys.argv[sys.argv.index(name) + 1] if name in sys.argv[1:-1] else default
+
+# profile output set by the --profile argument, used when a job doesn't set its own.
+# unlike the PROFILE parameter, it also covers loading the model in worker mode
+PROFILE_ARG = get_argument("--profile")
+
+# weights of the model, either "imagenet" (downloaded by keras the first time)
+# or a path to a local weights file, so the model can be loaded offline
+WEIGHTS_ARG = get_argument("--weights", "imagenet")
+
+# directory with the layers exported using --export. when set, the layers are
+# loaded from there instead of building the whole InceptionV3 (see export_layers)
+EXPORTED_ARG = get_argument("--exported")
+
+# threads used by a single operation and operations run in parallel, 0 = decided by tensorflow.
+# set by DreamScheduler.py, so several workers can share the cores without oversubscribing them
+INTRA_THREADS_ARG = int(get_argument("--intra-threads", "0"))
+INTER_THREADS_ARG = int(get_argument("--inter-threads", "0"))
 
 # read the content of params.txt and split it into separate lines
 # each line represents a single parameter
@@ -30,55 +134,79 @@ def read_params_file():
     content = file.read()
     file.close()
     content_arr = content.split("\n")
-    assert len(content_arr) == PARAMS_LEN
-    return content.split("\n")
+    assert len(content_arr) >= PARAMS_LEN
+    return content_arr
 
-# update the local variables depending on the imported parameters
-def import_params():
-    global VERBOSE, IMG_NAME, IMG_ORIGIN, IMG_ORIGIN_FORMAT, OUTPUT_PATH, DONE, DISTORTION_RATE, OCTAVES, OCT_SCALE, ITERATIONS, MAX_LOSS, LAYERS, LAYER_ACTIVATIONS
-    params = read_params_file()
+# update the global variables from a dictionary of named parameters
+def apply_params(params):
+    for name, convert in PARAMS:
+        globals()[name] = convert(params[name])
+
+    for name, convert, default in OPTIONAL_PARAMS:
+        globals()[name] = convert(params[name]) if name in params else default
 
-    VERBOSE = params[0] == "True"
+    assert TILE_SIZE == 0 or TILE_SIZE >= MIN_TILE_SIZE, f"tile size has to be 0 or at least {MIN_TILE_SIZE}, got {TILE_SIZE}"
+    assert TILE_SIZE == 0 or 0 <= TILE_OVERLAP < TILE_SIZE
+    assert BATCH_SIZE > 0
+    assert PREVIEW_EVERY >= 0 and PREVIEW_KEEP > 0
 
-    IMG_NAME = params[1]
-    IMG_ORIGIN = params[2]
-    IMG_ORIGIN_FORMAT = int(params[3])
-    OUTPUT_PATH = params[4]
-    DONE = params[5]
+    InputCache.configure(CACHE_DIR, CACHE_SIZE, ORIGIN_MIRROR)
+    Profiler.configure(PROFILE if PROFILE != "" else PROFILE_ARG)
+
+# update the global variables depending on the parameters in params.txt
+def import_params():
+    params = read_params_file()
+    named_params = {name : params[i] for i, (name, _) in enumerate(PARAMS)}
 
-    DISTORTION_RATE = float(params[6])
-    OCTAVES = int(params[7])
-    OCT_SCALE = float(params[8])
-    ITERATIONS = int(params[9])
-    MAX_LOSS = float(params[10])
+    # the rest of the lines are the optional NAME=value parameters
+    for line in params[PARAMS_LEN:]:
+        if line.strip() != "":
+            name, value = line.split("=", 1)
+            named_params[name.strip()] = value.strip()
 
-    LAYERS = params[11].split(" ")
-    LAYER_ACTIVATIONS = params[12].split(" ")
+    apply_params(named_params)
 
 # used to download the image
 def get_url_file(name, origin):
     return keras.utils.get_file(name, origin = origin)
 
+# returns the local path of the image, downloading it first if needed
+# origin format: 0 = file path, 1 = url
+def get_img_path(name, origin, format):
+    if format == 1:
+        if InputCache.is_enabled():
+            return InputCache.fetch(name, origin)
+        return get_url_file(name, origin)
+    return origin
+
 # returns the image and its shape
 # origin format: 0 = file path, 1 = url
 def get_img_shape(name, origin, format):
-    img_path = origin
-    if format == 1:
-        img_path = get_url_file(name, origin)
+    img_path = get_img_path(name, origin, format)
 
     o_img = preprocess_image(img_path)
     o_shape = o_img.shape[1:3]
     return o_img, o_shape
 
-# preprocess the image into a form compatible with the network
+# identifies the preprocessing below in the input cache,
+# it has to be changed whenever the preprocessing changes
+PREPROCESSING = "inception_v3-float32"
+
+# preprocess the image into a form compatible with the network. when the input
+# cache is enabled, an image is only preprocessed the first time it's used
 def preprocess_image(image_path):
+    if InputCache.is_enabled():
+        return InputCache.load_array(image_path, PREPROCESSING, load_and_preprocess_image)
+    return load_and_preprocess_image(image_path)
+
+def load_and_preprocess_image(image_path):
     img = keras.utils.load_img(image_path)
     img = keras.utils.img_to_array(img)
     img = np.expand_dims(img, axis = 0)
     img = keras.applications.inception_v3.preprocess_input(img)
     return img
 
-# reversed function above
+# reversed function above (expects a batch containing a single image)
 def deprocess_image(img):
     img = img.reshape((img.shape[1], img.shape[2], 3))
     img /= 2.0
@@ -98,56 +226,301 @@ def calculate_consecutive_shapes(original):
 
 
 # doesn't really calculate loss, but rather layer activation
-def calculate_loss(input_image):
+def calculate_loss(feature_extractor, input_image, coefficient):
     # the extracted layer
     # this processes the input image with the given layers
     features = feature_extractor(input_image)
 
-    loss = tf.zeros(shape=())
+    loss = tf.zeros(shape = tf.shape(input_image)[:1])
 
     # loop through the extracted features (in our case just a single layer)
     for name in features.keys():
-        # coefficient - how much should it affect the image
-        coefficient = layer_settings[name]
-
         # activations of the current extracted layer
         activation = features[name]
 
-        # mean squared activations
-        mean_sq_act = tf.reduce_mean(tf.square(activation))
+        # mean squared activations, separately for each image in the batch
+        mean_sq_act = tf.reduce_mean(tf.square(activation), axis = [1, 2, 3])
 
-        # update the loss value
+        # update the loss value, the coefficient says how much should it affect the image
         loss += coefficient * mean_sq_act
     return loss
 
-# as opposed to most neural networks, we actually try to maximize the 
-# loss function instead of minimizing it. this is called gradient ascent
-def gradient_ascent_step(image, distortion_rate):
-    # GradientTape record all tensor operations made with the image.
-    # it is a very useful tool for automatic differentiation
-    with tf.GradientTape() as tape:
-        tape.watch(image)
-        loss = calculate_loss(image)
-
-    # retroactively calculate the loss gradient with respect to the different parts of the image
-    gradients = tape.gradient(loss, image)
+# tensorflow takes seconds to import, so it's only imported once the model is
+# needed (e.g. checking the parameters using --check doesn't need it at all)
+def import_tensorflow():
+    global tf, keras, inception_v3, STEP_SIGNATURE, GRADIENTS_SIGNATURE
+    import tensorflow as tf
+    import tensorflow.keras as keras
+    import tensorflow.keras.applications.inception_v3 as inception_v3
+
+    tf.config.threading.set_intra_op_parallelism_threads(INTRA_THREADS_ARG)
+    tf.config.threading.set_inter_op_parallelism_threads(INTER_THREADS_ARG)
+
+    # image, distortion rate and layer coefficient. the image shape is left
+    # unspecified, so the step is traced only once and then reused for all
+    # the consecutive octave shapes instead of being retraced for each one
+    STEP_SIGNATURE = [
+        tf.TensorSpec(shape = [None, None, None, 3], dtype = tf.float32),
+        tf.TensorSpec(shape = [], dtype = tf.float32),
+        tf.TensorSpec(shape = [], dtype = tf.float32)
+    ]
+
+    # image and layer coefficient
+    GRADIENTS_SIGNATURE = [STEP_SIGNATURE[0], STEP_SIGNATURE[2]]
+
+# creates the graph-compiled functions for the given feature extractor
+def compile_layer_functions(feature_extractor):
+    @tf.function(input_signature = GRADIENTS_SIGNATURE)
+    def calculate_gradients(image, coefficient):
+        # GradientTape record all tensor operations made with the image.
+        # it is a very useful tool for automatic differentiation
+        with tf.GradientTape() as tape:
+            tape.watch(image)
+            loss = calculate_loss(feature_extractor, image, coefficient)
+
+        # retroactively calculate the loss gradient with respect to the different parts of the image.
+        # the images in the batch don't affect each other, so the gradient of the losses' sum is
+        # the same as if the gradient of each image was calculated separately
+        gradients = tape.gradient(loss, image)
+        return loss, gradients
+
+    # as opposed to most neural networks, we actually try to maximize the
+    # loss function instead of minimizing it. this is called gradient ascent
+    @tf.function(input_signature = STEP_SIGNATURE)
+    def gradient_ascent_step(image, distortion_rate, coefficient):
+        loss, gradients = calculate_gradients(image, coefficient)
+
+        # without normalizing the gradients, layers with lower activations would become unnoticeable
+        gradients = tf.math.l2_normalize(gradients, axis = [1, 2, 3])
+
+        # update the image using the calculated gradients
+        image += distortion_rate * gradients
+        return loss, image
+
+    return gradient_ascent_step, calculate_gradients
+
+# start positions of the tiles along a single dimension. the last tile
+# is aligned with the end of the image so that it is always full-sized
+def tile_starts(length):
+    if length <= TILE_SIZE:
+        return [0]
+
+    stride = TILE_SIZE - TILE_OVERLAP
+    return list(range(0, length - TILE_SIZE, stride)) + [length - TILE_SIZE]
+
+# blending weights of a single tile. the weights linearly fall off towards
+# the tile borders within the overlap, so the neighbouring tiles fade into
+# each other instead of having a hard edge between them
+def tile_window(height, width):
+    def ramp(length):
+        distance = np.minimum(np.arange(1, length + 1), np.arange(length, 0, -1))
+        return np.minimum(distance / (TILE_OVERLAP + 1), 1.0).astype("float32")
+
+    return np.outer(ramp(height), ramp(width)).reshape((1, height, width, 1))
+
+# the tiled version of gradient_ascent_step. the image is split into overlapping
+# tiles and the gradients are calculated for each tile separately, which means
+# the memory needed by the network is bounded by the tile size instead of the
+# image size. the gradients are then blended back together and normalized over
+# the whole image. the tile grid is randomly shifted every iteration, otherwise
+# the seams between the tiles would become visible in the output
+def tiled_gradient_ascent_step(image, distortion_rate, coefficient):
+    height, width = image.shape[1], image.shape[2]
+
+    # rather than shifting the grid, roll the image (the shift is reverted afterwards)
+    shift = np.random.randint(0, TILE_SIZE, size = 2)
+    image_shifted = tf.roll(image, shift = shift, axis = [1, 2])
+
+    gradients = np.zeros(image.shape, dtype = "float32")
+    weights = np.zeros((1, height, width, 1), dtype = "float32")
+    losses = []
+
+    for y in tile_starts(height):
+        for x in tile_starts(width):
+            tile_height, tile_width = min(TILE_SIZE, height), min(TILE_SIZE, width)
+            tile = image_shifted[:, y : y + tile_height, x : x + tile_width, :]
+
+            loss, tile_gradients = calculate_gradients(tile, coefficient)
+            window = tile_window(tile_height, tile_width)
+
+            gradients[:, y : y + tile_height, x : x + tile_width, :] += tile_gradients.numpy() * window
+            weights[:, y : y + tile_height, x : x + tile_width, :] += window
+            losses.append(loss)
+
+    gradients = tf.roll(gradients / weights, shift = -shift, axis = [1, 2])
 
     # without normalizing the gradients, layers with lower activations would become unnoticeable
-    gradients = tf.math.l2_normalize(gradients)
+    gradients = tf.math.l2_normalize(gradients, axis = [1, 2, 3])
 
-    # update the image using the calculated gradients
+    # update the image using the calculated gradients, the loss is averaged
+    # over the tiles, so it stays comparable with the untiled version
     image += distortion_rate * gradients
-    return loss, image
+    return tf.reduce_mean(losses, axis = 0), image
 
 # loop repeats NUM_OCTAVE times with ITERATIONS steps
+# returns the image and the number of iterations done
 def gradient_ascent_loop(image, iterations, distortion_rate, max_loss):
+    coefficient = tf.constant(CUR_LAYER_ACTIVATION, dtype = tf.float32)
+
+    # tiling only makes sense once the image is larger than a single tile
+    step = gradient_ascent_step
+    if TILE_SIZE > 0 and max(image.shape[1:3]) > TILE_SIZE:
+        step = tiled_gradient_ascent_step
+
+    # indices of the images in the batch which haven't met the maximum loss yet
+    active = np.arange(image.shape[0])
+
+    iterations_done = 0
     for i in range(iterations):
-        loss, image = gradient_ascent_step(image, distortion_rate)
+        with Profiler.phase("iteration", layer = CUR_LAYER_INDEX + 1, octave = CUR_OCTAVE + 1, iteration = i + 1, images = len(active)):
+            if len(active) == image.shape[0]:
+                loss, image = step(image, distortion_rate, coefficient)
+            else:
+                # only the remaining images are processed, the finished ones stay as they are
+                loss, active_image = step(tf.gather(image, active), distortion_rate, coefficient)
+                image = tf.tensor_scatter_nd_update(image, active[:, np.newaxis], active_image)
 
-        # break the loop when maximum allowed loss is met
-        if max_loss is not None and loss >= max_loss:
-            break
-    return image
+            # this also waits for the step to finish
+            loss = loss.numpy()
+
+        iterations_done += 1
+
+        if PREVIEW and PREVIEW_EVERY > 0 and (i + 1) % PREVIEW_EVERY == 0:
+            queue_preview(image, iteration = i + 1)
+
+        # only stores the latest state, the console is written by a background thread
+        if VERBOSE:
+            Progress.update(f"   Octave {YELLOW}{CUR_OCTAVE + 1}/{OCTAVES}{WHITE}, iteration {i + 1}/{iterations}, loss {loss.max():.4f}",
+                            layer = CUR_LAYER_INDEX + 1, octave = CUR_OCTAVE + 1, iteration = i + 1, loss = loss.tolist())
+
+        if MessageProtocol.is_active():
+            MessageProtocol.send("progress", id = JOB_ID, layer = CUR_LAYER_INDEX + 1, octave = CUR_OCTAVE + 1,
+                                 iteration = i + 1, images = active.tolist(), loss = loss.tolist())
+
+        # each image stops when its maximum allowed loss is met,
+        # the loop is broken once all images in the batch stop
+        if max_loss is not None:
+            active = active[loss < max_loss]
+            if len(active) == 0:
+                break
+    return image, iterations_done
+
+# the previews are saved by a background thread, so the gradient loop only hands over
+# the current image (tensors can't change, so no copy is needed). when the thread is
+# still busy with the previous preview, only the latest one waits to be saved, the
+# older ones are dropped. each preview has the resolution of its octave
+preview_condition = threading.Condition()
+pending_preview = None
+preview_writer = None
+preview_busy = False
+preview_number = 0
+
+# returns the paths the previews of the given output images are saved to
+def get_preview_paths(output_paths, number):
+    paths = []
+    for j, output_path in enumerate(output_paths):
+        stem, extension = os.path.splitext(output_path)
+        if PREVIEW_PATH != "":
+            stem, extension = os.path.splitext(PREVIEW_PATH)
+            if len(output_paths) > 1:
+                stem = f"{stem}_{j}"
+        else:
+            stem = f"{stem}.preview"
+
+        if PREVIEW_KEEP > 1:
+            stem = f"{stem}.{number % PREVIEW_KEEP}"
+        paths.append(f"{stem}{extension}")
+    return paths
+
+def queue_preview(image, **fields):
+    global pending_preview, preview_writer
+    with preview_condition:
+        pending_preview = (image, CUR_OUTPUT_PATHS, {"id" : JOB_ID, "layer" : CUR_LAYER_INDEX + 1, "octave" : CUR_OCTAVE + 1, **fields})
+        if preview_writer is None:
+            preview_writer = threading.Thread(target = write_previews, daemon = True)
+            preview_writer.start()
+        preview_condition.notify_all()
+
+# waits until the pending preview is saved, so no preview of a job is saved after its result
+def flush_previews():
+    with preview_condition:
+        while pending_preview is not None or preview_busy:
+            preview_condition.wait()
+
+def write_previews():
+    global pending_preview, preview_busy, preview_number
+    while True:
+        with preview_condition:
+            while pending_preview is None:
+                preview_condition.wait()
+            image, output_paths, fields = pending_preview
+            pending_preview, preview_busy = None, True
+
+        try:
+            image = image.numpy()
+            paths = get_preview_paths(output_paths, preview_number)
+            for j, path in enumerate(paths):
+                # written under a temporary name first, so whoever watches
+                # the preview never reads a partially written image
+                stem, extension = os.path.splitext(path)
+                keras.utils.save_img(f"{stem}.tmp{extension}", deprocess_image(np.array(image[j : j + 1])))
+                os.replace(f"{stem}.tmp{extension}", path)
+
+            preview_number += 1
+            MessageProtocol.send("preview", paths = paths, **fields)
+        except Exception as e:
+            print(f"Preview could not be saved: {e}", file = sys.stderr)
+
+        with preview_condition:
+            preview_busy = False
+            preview_condition.notify_all()
+
+# lost detail of the recently used source images, keyed by the source, the octave
+# shapes and the octave. kept for the whole lifetime of a worker, so it reuses them
+# across jobs dreaming on the same image (e.g. with different layers). the cache
+# is limited by the total size of the kept details, the oldest ones are removed first
+lost_detail_cache = OrderedDict()
+lost_detail_cache_bytes = 0
+LOST_DETAIL_CACHE_BYTES = 256 * 1024 * 1024
+
+# identifies the source images, changes whenever any of the files changes
+def get_source_key(img_paths):
+    key = []
+    for img_path in img_paths:
+        stat = os.stat(img_path)
+        key.append((os.path.abspath(img_path), stat.st_size, stat.st_mtime_ns))
+    return tuple(key)
+
+# calculates the detail lost by shrinking the original image for the given octave:
+# 1. upscale the original image shrunk to the previous octave, without any effect added
+# 2. downscale the original image to the size of this octave
+# 3. the difference between the two same sized images is the lost detail
+def calculate_lost_detail(original_img, consecutive_shapes, octave):
+    shape = consecutive_shapes[octave]
+    shrunk_original_img = tf.image.resize(original_img, consecutive_shapes[max(octave - 1, 0)])
+    return tf.image.resize(original_img, shape) - tf.image.resize(shrunk_original_img, shape)
+
+# returns the lost detail of the octave, it's only calculated once for each source
+# (when the source key is known, i.e. the image hasn't been dreamed on yet)
+def get_lost_detail(original_img, consecutive_shapes, octave, source_key):
+    global lost_detail_cache_bytes
+    if source_key is None:
+        return calculate_lost_detail(original_img, consecutive_shapes, octave)
+
+    key = (source_key, tuple(consecutive_shapes), octave)
+    if key in lost_detail_cache:
+        lost_detail_cache.move_to_end(key)
+        return lost_detail_cache[key]
+
+    lost_detail = calculate_lost_detail(original_img, consecutive_shapes, octave)
+    size = lost_detail.shape.num_elements() * lost_detail.dtype.size
+    if size <= LOST_DETAIL_CACHE_BYTES:
+        lost_detail_cache[key] = lost_detail
+        lost_detail_cache_bytes += size
+        while lost_detail_cache_bytes > LOST_DETAIL_CACHE_BYTES:
+            _, removed = lost_detail_cache.popitem(last = False)
+            lost_detail_cache_bytes -= removed.shape.num_elements() * removed.dtype.size
+    return lost_detail
 
 # this is the main loop. the idea is that first smaller and smaller
 # versions of the original image are calculated and then consecutively
@@ -156,44 +529,47 @@ def gradient_ascent_loop(image, iterations, distortion_rate, max_loss):
 # until reaching the original size on the last octave. during each 
 # octave, the "dream effect" also gets applied. the reason for changing
 # the resolution is that the dream patterns will not be the same size.
-def loop_octaves(original_img, original_shape):
+def loop_octaves(original_img, original_shape, source_key = None):
+    global CUR_OCTAVE
+
     # calculate the consecutive sizes going from the smallest to largest
     consecutive_shapes = calculate_consecutive_shapes(original_shape)
 
-    # create a copy of the original image with the initial (smallest) resolution
-    shrunk_original_img = tf.image.resize(original_img, consecutive_shapes[0])
-
     # clone the original image
     img = tf.identity(original_img)
 
     for i, shape in enumerate(consecutive_shapes):
+        CUR_OCTAVE = i
+
         if VERBOSE:
-            print(f"   Processing octave {YELLOW}{i + 1}/{OCTAVES}{WHITE} with shape {shape}    ", end = '\r')
+            Progress.update(f"   Processing octave {YELLOW}{i + 1}/{OCTAVES}{WHITE} with shape {shape}", layer = CUR_LAYER_INDEX + 1, octave = i + 1)
+
+        # optionally capture a profiler trace of the chosen octave
+        trace = Profiler.trace(PROFILE_TRACE_DIR) if PROFILE_TRACE_OCTAVE == i + 1 else nullcontext()
+
+        with trace, Profiler.phase("octave", layer = CUR_LAYER_INDEX + 1, octave = i + 1, shape = list(shape)) as fields:
+            # resize the image
+            img = tf.image.resize(img, shape)
 
-        # resize the image
-        img = tf.image.resize(img, shape)
+            # apply the "dream effect"
+            img, fields["iterations"] = gradient_ascent_loop(img, iterations = ITERATIONS, distortion_rate = DISTORTION_RATE, max_loss = MAX_LOSS)
 
-        # apply the "dream effect"
-        img = gradient_ascent_loop(img, iterations = ITERATIONS, distortion_rate = DISTORTION_RATE, max_loss = MAX_LOSS)
+            # add the lost detail back to the image with the dream effect
+            img += get_lost_detail(original_img, consecutive_shapes, i, source_key)
 
-        # 1. upscale the original image clone without any effect added
-        # 2. downscale the original image to the same size
-        # 3. calculate the difference between the two same sized images
-        # 4. add the lost detail back to the image with the dream effect
-        # 5. resize the shrunk clone to another size for the next octave
-        upscaled_shrunk_original_img = tf.image.resize(shrunk_original_img, shape)
-        same_size_original = tf.image.resize(original_img, shape)
-        lost_detail = same_size_original - upscaled_shrunk_original_img
-        img += lost_detail
-        shrunk_original_img = tf.image.resize(original_img, shape)
+        if PREVIEW:
+            queue_preview(img, iterations = fields["iterations"])
 
     if VERBOSE:
-        print(f"   Finished octave {YELLOW}{OCTAVES}/{OCTAVES}{WHITE}                                       ")
+        Progress.log(f"   Finished octave {YELLOW}{OCTAVES}/{OCTAVES}{WHITE}", layer = CUR_LAYER_INDEX + 1, octave = OCTAVES)
 
     return img
 
-# creates the feature extractor for each layer
-def extract_layer(name):
+# compiled layer functions, one pair for each layer. they are kept for the
+# whole lifetime of the script, so a worker reuses them across jobs as well
+compiled_functions = dict()
+
+def create_feature_extractor(name):
     # feature extraction is a process during which an intermediate output
     # of a given layer is extracted. this means stopping the model in one
     # of its hidden layers and taking the current result without continuing
@@ -205,8 +581,46 @@ def extract_layer(name):
 
     # create a new extraction model starting with the same input as the
     # original model, but ending in the required extraction layer
-    global feature_extractor
-    feature_extractor = keras.Model(inputs = model.inputs, outputs = outputs_dict)
+    return keras.Model(inputs = model.inputs, outputs = outputs_dict)
+
+# creates the feature extractor for each layer
+def extract_layer(name):
+    global gradient_ascent_step, calculate_gradients
+
+    # both the extractor and the compiled functions only get created when the
+    # layer is used for the first time, after that they are just reused
+    if name not in compiled_functions:
+        if EXPORTED_ARG != "":
+            compiled_functions[name] = load_exported_layer(name)
+        else:
+            compiled_functions[name] = compile_layer_functions(create_feature_extractor(name))
+
+    gradient_ascent_step, calculate_gradients = compiled_functions[name]
+
+# saves each of the given layers as a SavedModel containing only the part of
+# InceptionV3 up to the layer, along with both compiled functions. they are also
+# saved as signatures, so the layers can be used without python as well
+def export_layers(export_dir, layers):
+    for name in layers:
+        layer = tf.Module()
+        layer.feature_extractor = create_feature_extractor(name)
+        layer.gradient_ascent_step, layer.calculate_gradients = compile_layer_functions(layer.feature_extractor)
+
+        tf.saved_model.save(layer, os.path.join(export_dir, name), signatures = {
+            "gradient_ascent_step" : layer.gradient_ascent_step.get_concrete_function(),
+            "calculate_gradients" : layer.calculate_gradients.get_concrete_function()
+        })
+        print(f"   {GREEN}{CIRCLE}{WHITE} Layer {GREEN}{name}{WHITE} exported")
+
+# loading an exported layer only loads the weights the layer actually uses
+# and the already traced functions, the whole model is never built
+def load_exported_layer(name):
+    path = os.path.join(EXPORTED_ARG, name)
+    if not os.path.isdir(path):
+        raise FileNotFoundError(f"layer {name} hasn't been exported to {EXPORTED_ARG}, export it using --export")
+
+    layer = tf.saved_model.load(path)
+    return layer.gradient_ascent_step, layer.calculate_gradients
 
 def create_layer_dict():
     global layer_settings
@@ -215,58 +629,287 @@ def create_layer_dict():
     for i in range(len(LAYERS)):
         layer_settings[LAYERS[i]] = int(LAYER_ACTIVATIONS[i])
 
-def loop_layers():
-    global CUR_LAYER, CUR_LAYER_ACTIVATION
-
-    img, shape = get_img_shape(IMG_NAME, IMG_ORIGIN, IMG_ORIGIN_FORMAT)
-
-    i = 0
-    for layer in layer_settings.keys():
+# the checkpoint of a stack is saved next to the output of its first image
+def get_checkpoint_path(output_paths):
+    return f"{output_paths[0]}.checkpoint.npz"
+
+# identifies the job a checkpoint belongs to, a checkpoint of a different
+# job (or of the same job with different parameters) is never resumed
+def get_checkpoint_fingerprint(img_paths):
+    return json.dumps([img_paths, LAYERS, LAYER_ACTIVATIONS, DISTORTION_RATE, OCTAVES, OCT_SCALE, ITERATIONS, MAX_LOSS, TILE_SIZE, TILE_OVERLAP])
+
+# saves the images (still as floats) along with the index of the last finished layer
+def save_checkpoint(checkpoint_path, fingerprint, layer_index, img):
+    # write into a temporary file first, so a crash while saving doesn't corrupt the checkpoint
+    temp_path = f"{checkpoint_path}.tmp"
+    with open(temp_path, "wb") as file:
+        np.savez(file, img = np.asarray(img), layer_index = layer_index, fingerprint = fingerprint)
+    os.replace(temp_path, checkpoint_path)
+
+# returns the saved images and the index of the last finished layer,
+# or None when there is no checkpoint matching the fingerprint
+def load_checkpoint(checkpoint_path, fingerprint):
+    if not os.path.exists(checkpoint_path):
+        return None
+
+    with np.load(checkpoint_path) as checkpoint:
+        if str(checkpoint["fingerprint"]) != fingerprint:
+            return None
+        return checkpoint["img"], int(checkpoint["layer_index"])
+
+# the images go through the layers all at once, stacked into a single batch.
+# the output of each layer is kept in memory and directly becomes the input
+# of the next layer, the images are only saved to disk after the last layer
+def loop_layers(img, img_paths, output_paths):
+    global CUR_LAYER_INDEX, CUR_LAYER, CUR_LAYER_ACTIVATION, CUR_OUTPUT_PATHS
+
+    shape = img.shape[1:3]
+    CUR_OUTPUT_PATHS = output_paths
+
+    checkpoint_path = get_checkpoint_path(output_paths)
+    fingerprint = get_checkpoint_fingerprint(img_paths)
+
+    # continue from the last finished layer of an interrupted run
+    last_layer_index = -1
+    if CHECKPOINT:
+        checkpoint = load_checkpoint(checkpoint_path, fingerprint)
+        if checkpoint is not None:
+            img, last_layer_index = checkpoint
+            if VERBOSE:
+                Progress.log(f"Resuming from checkpoint after layer {last_layer_index + 1}", layer = last_layer_index + 1)
+
+    for i, (layer, activation) in enumerate(layer_settings.items()):
+        if i <= last_layer_index:
+            continue
+
+        CUR_LAYER_INDEX = i
         CUR_LAYER = layer
-        CUR_LAYER_ACTIVATION = layer_settings[layer]
+        CUR_LAYER_ACTIVATION = activation
 
         if VERBOSE:
-            print(f"{CYAN}Layer {i + 1}{WHITE} - Name: {GREEN}{CUR_LAYER}{WHITE}; Activation: {CUR_LAYER_ACTIVATION}")
+            Progress.log(f"{CYAN}Layer {i + 1}{WHITE} - Name: {GREEN}{CUR_LAYER}{WHITE}; Activation: {CUR_LAYER_ACTIVATION}",
+                         layer = i + 1, name = layer, activation = activation)
+
+        with Profiler.phase("layer", layer = i + 1, layer_name = layer) as fields:
+            extract_layer(layer)
+
+            # only the first layer dreams on the source images themselves, the
+            # following layers continue with the output of the previous layer.
+            # the lost details are only cached by a worker (a single run never
+            # reuses them) and not for tiled images, which are too large to keep
+            tiled = TILE_SIZE > 0 and max(shape) > TILE_SIZE
+            cacheable = i == 0 and MessageProtocol.is_active() and not tiled
+            source_key = get_source_key(img_paths) if cacheable else None
+
+            # the images used to be saved and loaded back after each layer, which also
+            # clipped them to the valid range. the clipping is kept, so the results
+            # stay the same, just without losing precision to the 8-bit quantization
+            img = tf.clip_by_value(loop_octaves(img, shape, source_key), -1.0, 1.0)
+
+            # how many times the compiled functions of this layer have been traced so far,
+            # more than once per layer (and function) means something is causing retracing
+            # (the exported functions are already traced, they can't be retraced)
+            if hasattr(gradient_ascent_step, "experimental_get_tracing_count"):
+                fields["traces"] = gradient_ascent_step.experimental_get_tracing_count() + calculate_gradients.experimental_get_tracing_count()
+
+        if CHECKPOINT and i != len(layer_settings) - 1:
+            save_checkpoint(checkpoint_path, fingerprint, i, img)
 
-        extract_layer(layer)
+        if VERBOSE:
+            Progress.log()
 
-        output = loop_octaves(img, shape)
+    if PREVIEW:
+        flush_previews()
 
-        # save the current image into output folder, if this isn't the' last iteration,
-        # the saved image will be reused as the input for the next cycle (layer)
-        keras.utils.save_img(OUTPUT_PATH, deprocess_image(output.numpy()))
-        if (i != len(LAYERS) - 1):
-            img, shape = get_img_shape(IMG_NAME, OUTPUT_PATH, 0)
+    # save the final images into output folder
+    with Profiler.phase("save", images = len(output_paths)):
+        for j, output_path in enumerate(output_paths):
+            keras.utils.save_img(output_path, deprocess_image(np.array(img[j : j + 1])))
 
-        if VERBOSE:
-            print("")
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
 
-        i += 1
     return img
 
-import_params()
-
-if VERBOSE:
-    print(f"Running DeepDream:")
-    print(f"   {GREEN}{CIRCLE}{WHITE} Input source: {IMG_ORIGIN}")
-    print(f"   {GREEN}{CIRCLE}{WHITE} Output path: {OUTPUT_PATH}")
-    print(f"   {GREEN}{CIRCLE}{WHITE} Layers to iterate: {RED}{len(LAYERS)}{WHITE}\n")
-
-create_layer_dict()
+# returns the images to process along with their output paths. in batch mode,
+# the outputs are numbered after the order of inputs, e.g. dream_0.png
+def get_inputs():
+    if len(BATCH_INPUTS) == 0:
+        return [(IMG_NAME, IMG_ORIGIN, OUTPUT_PATH)]
+
+    stem, extension = os.path.splitext(OUTPUT_PATH)
+    return [(os.path.basename(origin), origin, f"{stem}_{i}{extension}") for i, origin in enumerate(BATCH_INPUTS)]
+
+# groups the images by their shape (images of the same shape also share the
+# octave shapes, so they can be stacked into a single batch) and splits each
+# group into stacks of at most BATCH_SIZE images. only the image headers are
+# read here, the images themselves get loaded when their stack is processed
+def create_stacks(inputs):
+    groups = dict()
+    for name, origin, output_path in inputs:
+        with Profiler.phase("image_fetch", origin = origin):
+            img_path = get_img_path(name, origin, IMG_ORIGIN_FORMAT)
+            with Image.open(img_path) as image:
+                width, height = image.size
+        groups.setdefault((height, width), []).append((img_path, output_path))
+
+    stacks = []
+    for group in groups.values():
+        for i in range(0, len(group), BATCH_SIZE):
+            stacks.append(group[i : i + BATCH_SIZE])
+    return stacks
 
 # neural network model pretrained on imagenet database
 # pretrained weights save time and work, training out own network would be too difficult
-model = inception_v3.InceptionV3(weights = "imagenet", include_top = False)
+def load_model():
+    global model
+    with Profiler.phase("model_load"):
+        import_tensorflow()
 
-#print([layer.name for layer in model.layers])
+        # the exported layers don't need the model at all
+        model = None
+        if EXPORTED_ARG == "":
+            model = inception_v3.InceptionV3(weights = WEIGHTS_ARG, include_top = False)
 
-# run the generator
-output_img = loop_layers()
+    #print([layer.name for layer in model.layers])
 
-# create a file named after the current iteration number
-# this lets the main C# program know that the work here is done
-f = open(DONE, "w")
-f.close()
+# runs the generator with the currently imported parameters
+# returns the paths of all saved output images
+def run_job():
+    if VERBOSE:
+        source = IMG_ORIGIN if len(BATCH_INPUTS) == 0 else f"{len(BATCH_INPUTS)} images"
+        Progress.log(f"Running DeepDream:", id = JOB_ID)
+        Progress.log(f"   {GREEN}{CIRCLE}{WHITE} Input source: {source}", source = source)
+        Progress.log(f"   {GREEN}{CIRCLE}{WHITE} Output path: {OUTPUT_PATH}", output = OUTPUT_PATH)
+        Progress.log(f"   {GREEN}{CIRCLE}{WHITE} Layers to iterate: {RED}{len(LAYERS)}{WHITE}", layers = len(LAYERS))
+        Progress.log()
+
+    create_layer_dict()
+
+    outputs = []
+    with Profiler.phase("job", id = JOB_ID) as fields:
+        stacks = create_stacks(get_inputs())
+        for i, stack in enumerate(stacks):
+            if VERBOSE and len(stacks) > 1:
+                Progress.log(f"{MAGENTA}Stack {i + 1}/{len(stacks)}{WHITE} - Images: {len(stack)}", stack = i + 1, images = len(stack))
+
+            with Profiler.phase("preprocess", images = len(stack)):
+                img = np.concatenate([preprocess_image(img_path) for img_path, _ in stack])
+
+            # run the generator
+            output_paths = [output_path for _, output_path in stack]
+            output_img = loop_layers(img, [img_path for img_path, _ in stack], output_paths)
+            outputs += output_paths
+
+        fields["images"] = len(outputs)
+
+    # when run using params.txt, create the DONE file to let
+    # anyone waiting for the output know that the work here is done
+    if DONE != "":
+        f = open(DONE, "w")
+        f.close()
+
+    if VERBOSE:
+        Progress.log(f"Output image successfully saved to: {OUTPUT_PATH}", outputs = outputs)
+        Progress.stop()
+
+    return outputs
+
+# in worker mode, the model is only loaded once and the script then keeps
+# serving jobs sent by the host using the message protocol (MessageProtocol.py).
+# the job parameters are named the same as in PARAMS and OPTIONAL_PARAMS, the
+# host is notified about the progress and the result (or error) of each job
+def run_worker():
+    global JOB_ID
+
+    MessageProtocol.start()
+    Profiler.configure(PROFILE_ARG)
+    load_model()
+    MessageProtocol.send("ready")
+
+    for message in MessageProtocol.receive():
+        if message.get("type") == "exit":
+            break
 
-if VERBOSE:
-    print(f"Output image successfully saved to: {OUTPUT_PATH}")
\ No newline at end of file
+        # a single worker runs the jobs one by one, so the cancellation would only be read
+        # once the job is finished. only DreamScheduler.py can cancel jobs, here the message
+        # is ignored (an error of an already finished job would fail all the jobs on the host)
+        if message.get("type") == "cancel":
+            print(f"Job {message.get('id')} can't be cancelled, use DreamScheduler.py to cancel jobs", file = sys.stderr)
+            continue
+
+        JOB_ID = message.get("id")
+        if message.get("type") != "job":
+            MessageProtocol.send("error", id = JOB_ID, message = f"unknown message type: {message.get('type')}")
+            continue
+
+        start = time.perf_counter()
+        try:
+            # the DONE file is only needed when using params.txt
+            apply_params({"DONE" : "", **message["params"]})
+            outputs = run_job()
+            MessageProtocol.send("result", id = JOB_ID, outputs = outputs, time = time.perf_counter() - start)
+        except Exception as e:
+            MessageProtocol.send_error(JOB_ID, e)
+
+        JOB_ID = None
+
+# validates the imported parameters without loading tensorflow or the model,
+# returns the list of problems found (empty when everything is fine)
+def check_params():
+    problems = []
+    if len(LAYERS) != len(LAYER_ACTIVATIONS):
+        problems.append(f"{len(LAYERS)} layers, but {len(LAYER_ACTIVATIONS)} layer activations")
+    for activation in LAYER_ACTIVATIONS:
+        if not activation.lstrip("-").isdigit():
+            problems.append(f"layer activation {activation} is not a whole number")
+
+    if OCTAVES < 1:
+        problems.append(f"at least one octave is required, got {OCTAVES}")
+    if OCT_SCALE <= 0:
+        problems.append(f"octave scale has to be positive, got {OCT_SCALE}")
+    if ITERATIONS < 0:
+        problems.append(f"number of iterations can't be negative, got {ITERATIONS}")
+    if TILE_SIZE != 0 and TILE_SIZE < MIN_TILE_SIZE:
+        problems.append(f"tile size has to be 0 or at least {MIN_TILE_SIZE}, got {TILE_SIZE}")
+
+    if IMG_ORIGIN_FORMAT == 0:
+        for origin in BATCH_INPUTS if len(BATCH_INPUTS) > 0 else [IMG_ORIGIN]:
+            if not os.path.isfile(origin):
+                problems.append(f"input image {origin} doesn't exist")
+
+    output_dir = os.path.dirname(OUTPUT_PATH)
+    if output_dir != "" and not os.path.isdir(output_dir):
+        problems.append(f"output directory {output_dir} doesn't exist")
+
+    preview_dir = os.path.dirname(PREVIEW_PATH)
+    if PREVIEW and preview_dir != "" and not os.path.isdir(preview_dir):
+        problems.append(f"preview directory {preview_dir} doesn't exist")
+    return problems
+
+if __name__ == "__main__":
+    if "--check" in sys.argv[1:]:
+        try:
+            import_params()
+            problems = check_params()
+        except (AssertionError, ValueError, KeyError, IndexError) as e:
+            problems = [f"invalid parameters: {type(e).__name__} {e}"]
+
+        for problem in problems:
+            print(f"   {RED}{CIRCLE}{WHITE} {problem}")
+        if len(problems) > 0:
+            sys.exit(1)
+        print(f"Parameters are valid.")
+    elif "--export" in sys.argv[1:-1]:
+        # exports the layers given by --layers (separated by commas), all the mixed layers by default
+        EXPORTED_ARG = ""
+        load_model()
+        layers = get_argument("--layers", ",".join(f"mixed{i}" for i in range(11))).split(",")
+        print(f"Exporting {len(layers)} layers to: {get_argument('--export')}")
+        export_layers(get_argument("--export"), layers)
+    elif "--worker" in sys.argv[1:]:
+        run_worker()
+    else:
+        import_params()
+        load_model()
+        run_job()
\ No newline at end of file
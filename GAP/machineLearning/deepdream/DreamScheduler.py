@@ -0,0 +1,362 @@
+#
+# GAP - Generative Art Producer
+#   by ZlomenyMesic & KryKom
+#
+#      founded 11.9.2024
+#
+
+# RUNS SEVERAL DEEPDREAM JOBS AT ONCE ON A POOL OF WORKERS:
+# a single DeepDream job only uses a fraction of a many-core machine. the
+# scheduler starts several DeepDream workers (see run_worker in DeepDream.py),
+# splits the cores between them and runs the queued jobs on whichever worker
+# is free. each worker is pinned to its own cores and limited to the same
+# number of tensorflow threads, so the workers don't fight over the cores.
+#
+# the scheduler speaks the same message protocol as a single worker (see
+# MessageProtocol.py), so the host can use it in place of DeepDream.py --worker.
+# on top of that, a job may contain a "priority" (higher is started first, the
+# same priority keeps the order of submission) and the host can send
+#   {"type": "cancel", "id": "1"}
+# to cancel a job, which is answered by {"type": "cancelled", "id": "1"}.
+# a queued job is simply dropped, a running one is stopped by killing its
+# worker, which is then started again.
+#
+# each job runs in its own directory inside JOBS_DIR, so jobs never share
+# their intermediate files (checkpoints, partially written images) even when
+# they have the same OUTPUT_PATH. the finished images are then moved to the
+# requested output directory. the job directories are named after the session
+# of the scheduler (the host numbers the jobs from 1 again every session) and
+# they are removed once the job finishes, fails or is cancelled.
+#
+# when a worker can't be started again after a crash or a cancellation, the
+# other workers take over its jobs. once no worker is left, all the queued
+# and newly submitted jobs fail right away instead of waiting forever.
+#
+# usage:
+#   python DreamScheduler.py [--workers N] [--threads N] [--jobs-dir DIR] [--weights FILE] [--exported DIR]
+# the number of workers and threads default to the number of cores divided
+# by DEFAULT_THREADS and the cores divided by the workers respectively
+
+import sys, os, re, json, time, heapq, shutil, itertools, threading, subprocess
+sys.path.append(os.path.relpath(r"..\..\..\machinelearning\utils"))
+import MessageProtocol
+
+DEEPDREAM_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "DeepDream.py")
+UTILS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "utils")
+
+# a single job doesn't get much faster with more threads than this
+DEFAULT_THREADS = 8
+
+# returns the value following the given command line argument
+def get_argument(name, default = ""):
+    return sys.argv[sys.argv.index(name) + 1] if name in sys.argv[1:-1] else default
+
+WORKERS_ARG = int(get_argument("--workers", "0"))
+THREADS_ARG = int(get_argument("--threads", "0"))
+JOBS_DIR = get_argument("--jobs-dir", "jobs")
+
+# directory of the jobs of this session, unique even when several schedulers share JOBS_DIR
+SESSION_DIR = os.path.join(JOBS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}")
+
+# passed on to the workers
+WEIGHTS_ARG = get_argument("--weights")
+EXPORTED_ARG = get_argument("--exported")
+
+# queued jobs as (-priority, order of submission, id, params), and the ids
+# of the queued jobs which haven't been cancelled (cancelled jobs are only
+# left out when they're taken from the queue)
+queued_jobs = []
+queued_ids = set()
+submission_order = itertools.count()
+
+# running jobs and the workers running them
+running_jobs = dict()
+
+queue_condition = threading.Condition()
+stopping = False
+
+# number of workers which are still running
+live_workers = 0
+
+# returns the cores the scheduler is allowed to run on
+def get_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+# splits the cores evenly between the workers, the remaining cores are left unused
+def split_cores(cores, workers):
+    count = max(1, len(cores) // workers)
+    return [cores[i * count : (i + 1) * count] or cores for i in range(workers)]
+
+# pins the process to the given cores, using psutil where os can't do it (on Windows)
+def set_affinity(pid, cores):
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(pid, cores)
+        return
+
+    try:
+        import psutil
+    except ImportError:
+        print("Install psutil to pin the workers to their cores", file = sys.stderr)
+        return
+    psutil.Process(pid).cpu_affinity(cores)
+
+# starts a DeepDream worker limited to the cores and threads of the given worker
+def start_process(worker):
+    threads = worker["threads"]
+    args = [sys.executable, DEEPDREAM_SCRIPT, "--worker", "--intra-threads", str(threads), "--inter-threads", str(min(2, threads))]
+    if WEIGHTS_ARG != "":
+        args += ["--weights", WEIGHTS_ARG]
+    if EXPORTED_ARG != "":
+        args += ["--exported", EXPORTED_ARG]
+
+    # the native libraries used by tensorflow read their thread limits from the environment
+    env = dict(os.environ)
+    env["OMP_NUM_THREADS"] = str(threads)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [UTILS_DIR, env.get("PYTHONPATH")]))
+
+    worker["process"] = subprocess.Popen(args, stdin = subprocess.PIPE, stdout = subprocess.PIPE, env = env, text = True)
+    worker["cancelled"] = False
+    set_affinity(worker["process"].pid, worker["cores"])
+
+# reads the next message of the worker, None once the worker exits
+def read_message(worker):
+    line = worker["process"].stdout.readline()
+    while line != "" and line.strip() == "":
+        line = worker["process"].stdout.readline()
+    return json.loads(line) if line != "" else None
+
+# waits until the worker loads the model
+def wait_until_ready(worker):
+    message = read_message(worker)
+    while message is not None and message["type"] != "ready":
+        message = read_message(worker)
+
+    if message is None:
+        raise RuntimeError(f"worker {worker['index']} exited with code {worker['process'].wait()} before it was ready")
+
+def send_to_worker(worker, message):
+    worker["process"].stdin.write(json.dumps(message) + "\n")
+    worker["process"].stdin.flush()
+
+def stop_process(worker):
+    process = worker["process"]
+    if process.poll() is None:
+        try:
+            send_to_worker(worker, {"type" : "exit"})
+            process.stdin.close()
+        except OSError:
+            pass
+    process.wait()
+
+# returns why the job message can't be queued, None when it's fine. a broken
+# message only fails its own job, it must never stop the scheduler
+def check_job(message):
+    if message.get("id") is None:
+        return "the job has no id"
+    if not isinstance(message.get("params"), dict):
+        return "the job has no parameters"
+    try:
+        int(message.get("priority", 0))
+    except (TypeError, ValueError):
+        return f"invalid priority: {message['priority']}"
+    return None
+
+# adds a job to the queue
+def submit(id, params, priority):
+    with queue_condition:
+        if live_workers == 0:
+            MessageProtocol.send("error", id = id, message = "no DeepDream worker is running")
+            return
+        heapq.heappush(queued_jobs, (-priority, next(submission_order), id, params))
+        queued_ids.add(id)
+        queue_condition.notify()
+
+# takes the job with the highest priority, or returns None once the scheduler stops
+def take_job(worker):
+    with queue_condition:
+        while True:
+            while len(queued_jobs) > 0:
+                _, _, id, params = heapq.heappop(queued_jobs)
+                if id in queued_ids:
+                    queued_ids.remove(id)
+                    running_jobs[id] = worker
+                    return id, params
+
+            if stopping:
+                return None
+            queue_condition.wait()
+
+# fails all the queued jobs, called once the last worker is gone
+def fail_queued_jobs(message):
+    while len(queued_jobs) > 0:
+        _, _, id, _ = heapq.heappop(queued_jobs)
+        if id in queued_ids:
+            queued_ids.remove(id)
+            MessageProtocol.send("error", id = id, message = message)
+
+def cancel(id):
+    with queue_condition:
+        if id in queued_ids:
+            queued_ids.remove(id)
+            MessageProtocol.send("cancelled", id = id)
+        elif id in running_jobs:
+            # the worker can't be interrupted in the middle of a job. it's killed
+            # instead, and the cancellation is reported once it's really stopped
+            worker = running_jobs[id]
+            worker["cancelled"] = True
+            worker["process"].kill()
+        else:
+            # the job has already finished, an error would fail the whole scheduler on the host
+            print(f"Job {id} can't be cancelled, it isn't queued or running", file = sys.stderr)
+
+def get_job_dir(id):
+    return os.path.join(SESSION_DIR, re.sub(r"[^\w.-]", "_", str(id)))
+
+# the job parameters as sent to the worker. the outputs are written into the
+# directory of the job, and images downloaded from a URL get a name unique to
+# the job, so jobs downloading different images of the same name don't collide
+def prepare_params(params, job_dir):
+    params = {**params, "DONE" : ""}
+    params["OUTPUT_PATH"] = os.path.join(job_dir, os.path.basename(params["OUTPUT_PATH"]))
+    if int(params.get("IMG_ORIGIN_FORMAT", 0)) == 1 and params.get("CACHE_DIR", "") == "":
+        params["IMG_NAME"] = f"{os.path.basename(SESSION_DIR)}_{os.path.basename(job_dir)}_{params['IMG_NAME']}"
+    return params
+
+# moves the finished images from the job directory into the requested one
+def publish_outputs(outputs, output_path, job_dir):
+    output_dir = os.path.dirname(output_path)
+    if output_dir != "":
+        os.makedirs(output_dir, exist_ok = True)
+
+    published = []
+    for output in outputs:
+        destination = os.path.join(output_dir, os.path.basename(output))
+        shutil.move(output, destination)
+        published.append(destination)
+
+    shutil.rmtree(job_dir, ignore_errors = True)
+    return published
+
+# runs a single job on the worker and forwards its messages to the host
+def run_job(worker, id, params):
+    job_dir = get_job_dir(id)
+    os.makedirs(job_dir, exist_ok = True)
+    send_to_worker(worker, {"type" : "job", "id" : id, "params" : prepare_params(params, job_dir)})
+
+    while True:
+        message = read_message(worker)
+        if message is None:
+            shutil.rmtree(job_dir, ignore_errors = True)
+            if worker["cancelled"]:
+                MessageProtocol.send("cancelled", id = id)
+            else:
+                MessageProtocol.send("error", id = id, message = f"worker {worker['index']} exited with code {worker['process'].wait()}")
+            return
+
+        message_type = message.pop("type")
+        if message_type == "result":
+            message["outputs"] = publish_outputs(message["outputs"], params["OUTPUT_PATH"], job_dir)
+            MessageProtocol.send("result", **message, worker = worker["index"])
+            return
+
+        # any error while running the job (even one of the whole worker) fails only this job
+        if message_type == "error":
+            shutil.rmtree(job_dir, ignore_errors = True)
+            MessageProtocol.send("error", **{**message, "id" : id})
+            return
+        MessageProtocol.send(message_type, **message)
+
+# keeps running the queued jobs on the worker until the scheduler stops
+def serve_jobs(worker):
+    global live_workers
+
+    while True:
+        job = take_job(worker)
+        if job is None:
+            break
+
+        id, params = job
+        try:
+            run_job(worker, id, params)
+        except Exception as e:
+            shutil.rmtree(get_job_dir(id), ignore_errors = True)
+            # a cancellation may kill the worker before the job is even sent to it
+            if worker["cancelled"]:
+                MessageProtocol.send("cancelled", id = id)
+            else:
+                MessageProtocol.send_error(id, e)
+
+        with queue_condition:
+            running_jobs.pop(id, None)
+
+        # a cancelled (or crashed) worker is replaced by a new one
+        if worker["process"].poll() is not None or worker["cancelled"]:
+            stop_process(worker)
+            try:
+                start_process(worker)
+                wait_until_ready(worker)
+            except Exception as e:
+                print(f"Worker {worker['index']} could not be restarted: {e}", file = sys.stderr)
+                with queue_condition:
+                    live_workers -= 1
+                    if live_workers == 0:
+                        fail_queued_jobs(f"no DeepDream worker is running, the last one could not be restarted: {e}")
+                return
+
+    stop_process(worker)
+
+def main():
+    global stopping, live_workers
+
+    MessageProtocol.start()
+
+    cores = get_cores()
+    threads = THREADS_ARG if THREADS_ARG > 0 else None
+    workers = WORKERS_ARG if WORKERS_ARG > 0 else max(1, len(cores) // (threads or DEFAULT_THREADS))
+    core_sets = split_cores(cores, workers)
+
+    # the workers load the model at the same time
+    pool = [{"index" : i, "cores" : core_set, "threads" : threads or len(core_set)} for i, core_set in enumerate(core_sets)]
+    for worker in pool:
+        start_process(worker)
+    for worker in pool:
+        wait_until_ready(worker)
+    live_workers = len(pool)
+
+    print(f"Running {workers} DeepDream workers with {pool[0]['threads']} threads each", file = sys.stderr)
+
+    servers = [threading.Thread(target = serve_jobs, args = (worker,), daemon = True) for worker in pool]
+    for server in servers:
+        server.start()
+    MessageProtocol.send("ready", workers = workers)
+
+    for message in MessageProtocol.receive():
+        message_type = message.get("type")
+        if message_type == "exit":
+            break
+        elif message_type == "job":
+            problem = check_job(message)
+            if problem is None:
+                submit(message["id"], message["params"], int(message.get("priority", 0)))
+            elif message.get("id") is None:
+                # an error without an id would fail all the jobs on the host
+                print(f"Invalid job: {problem}", file = sys.stderr)
+            else:
+                MessageProtocol.send("error", id = message["id"], message = problem)
+        elif message_type == "cancel":
+            cancel(message.get("id"))
+        else:
+            MessageProtocol.send("error", id = message.get("id"), message = f"unknown message type: {message_type}")
+
+    # the queued jobs are still finished before the workers stop
+    with queue_condition:
+        stopping = True
+        queue_condition.notify_all()
+    for server in servers:
+        server.join()
+    shutil.rmtree(SESSION_DIR, ignore_errors = True)
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
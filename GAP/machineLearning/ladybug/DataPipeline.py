@@ -0,0 +1,143 @@
+#
+# GAP - Generative Art Producer
+#   by ZlomenyMesic & KryKom
+#
+#      founded 11.9.2024
+#
+
+# INPUT PIPELINE OF THE LADYBUG TRAINING:
+# the images of a subset are either listed in the manifest written by
+# CreateSubsets.py, or found in the class subdirectories of the subset
+# directory (the same layout image_dataset_from_directory expects).
+#
+# the images are decoded and resized in parallel, and the decoded images are
+# cached on disk, so the JPEG decoding only happens during the very first epoch
+# of the very first run. the cache is named after the hash of the image list,
+# sizes and modification times of the files and the image size, so any change
+# to the subset (even an image rewritten under the same name) creates a new
+# cache instead of reusing a stale one. the training subset is then augmented (also in parallel, see
+# create_augmentation) and the next batches are prefetched while the model trains
+# on the current one
+
+import os, csv, glob, random, hashlib
+import tensorflow as tf
+from tensorflow.keras import layers
+
+# formats supported by tf.io.decode_image
+EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".gif"}
+
+# number of decoded images the shuffling picks from. the whole subset doesn't fit
+# into memory, so the order of the files is also shuffled once before caching
+SHUFFLE_BUFFER = 1024
+
+# returns the paths and labels of the images from the given subset in the manifest,
+# along with the class names (the labels are indices into the sorted class names)
+def load_manifest(manifest_path, subset):
+    with open(manifest_path, newline = "") as file:
+        rows = list(csv.DictReader(file))
+
+    class_names = sorted({row["class"] for row in rows})
+    rows = [row for row in rows if row["subset"] == subset]
+    return [row["source"] for row in rows], [class_names.index(row["class"]) for row in rows], class_names
+
+# same as load_manifest, but the images are found in the class subdirectories
+def list_directory(dir):
+    class_names = sorted(name for name in os.listdir(dir) if os.path.isdir(os.path.join(dir, name)))
+
+    paths, labels = [], []
+    for label, class_name in enumerate(class_names):
+        for root, _, files in os.walk(os.path.join(dir, class_name)):
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in EXTENSIONS:
+                    paths.append(os.path.join(root, name))
+                    labels.append(label)
+    return paths, labels, class_names
+
+# the images are resized the same way image_dataset_from_directory does it,
+# so models trained using either of them get the same inputs
+def decode_image(path, label, img_size):
+    img = tf.io.decode_image(tf.io.read_file(path), channels = 3, expand_animations = False)
+    img = tf.image.resize(img, (img_size, img_size), method = "bilinear")
+    img.set_shape((img_size, img_size, 3))
+    return img, label
+
+# creates the augmentation applied to the training images. the random layers
+# used to be a part of the model, where they ran on the training step itself
+# and were also saved into the model, even though they do nothing at inference.
+# here, they run in the input pipeline on whole batches, in parallel with the
+# training. any of the augmentations can be disabled by setting it to None.
+# each layer gets its own seed derived from the given one, layers with the same
+# seed would draw the same random numbers and their decisions would be correlated
+def create_augmentation(flip = "horizontal", rotation = 0.1, zoom = 0.2, seed = None):
+    def layer_seed(offset):
+        return seed + offset if seed is not None else None
+
+    augmentation = []
+    if flip is not None:
+        augmentation.append(layers.RandomFlip(flip, seed = layer_seed(0)))
+    if rotation is not None:
+        augmentation.append(layers.RandomRotation(rotation, seed = layer_seed(1)))
+    if zoom is not None:
+        augmentation.append(layers.RandomZoom(zoom, seed = layer_seed(2)))
+
+    if len(augmentation) == 0:
+        return None
+    return tf.keras.Sequential(augmentation, name = "augmentation")
+
+def get_cache_path(cache_dir, name, paths, labels, img_size):
+    digest = hashlib.sha256(f"{img_size}".encode())
+    for path, label in zip(paths, labels):
+        stat = os.stat(path)
+        digest.update(f"{path}:{label}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return os.path.join(cache_dir, f"{name}-{digest.hexdigest()[:16]}")
+
+# a run killed during the first epoch leaves behind a lockfile and partial shards
+# of the cache (e.g. name_0.lockfile), which make the next run fail. the cache is
+# only complete once its index (name.index) is written, an incomplete one is removed
+def remove_incomplete_cache(cache_path):
+    if os.path.exists(f"{cache_path}.index"):
+        return
+    for path in glob.glob(f"{glob.escape(cache_path)}_*") + glob.glob(f"{glob.escape(cache_path)}.*"):
+        os.remove(path)
+
+# creates the dataset of a single subset. an empty cache directory keeps the
+# decoded images in memory instead (only for the duration of the run). the
+# augmentation is applied after the cache, so each epoch is augmented differently
+def create_dataset(paths, labels, name, img_size, batch_size, cache_dir = "", shuffle = False, seed = None, augmentation = None):
+    if shuffle:
+        order = list(zip(paths, labels))
+        random.Random(seed).shuffle(order)
+        paths, labels = [path for path, _ in order], [label for _, label in order]
+
+    dataset = tf.data.Dataset.from_tensor_slices((paths, labels))
+    dataset = dataset.map(lambda path, label: decode_image(path, label, img_size), num_parallel_calls = tf.data.AUTOTUNE)
+
+    if cache_dir != "":
+        os.makedirs(cache_dir, exist_ok = True)
+        cache_path = get_cache_path(cache_dir, name, paths, labels, img_size)
+        remove_incomplete_cache(cache_path)
+        dataset = dataset.cache(cache_path)
+    else:
+        dataset = dataset.cache()
+
+    # shuffled after caching, so each epoch gets a different order
+    if shuffle:
+        dataset = dataset.shuffle(buffer_size = SHUFFLE_BUFFER, seed = seed, reshuffle_each_iteration = True)
+
+    dataset = dataset.batch(batch_size)
+    if augmentation is not None:
+        dataset = dataset.map(lambda img, label: (augmentation(img, training = True), label), num_parallel_calls = tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+# loads a subset either from the manifest (when it exists) or from its directory
+def load_subset(dataset_dir, subset, img_size, batch_size, manifest_path = None, cache_dir = "", shuffle = False, seed = None, augmentation = None):
+    if manifest_path is not None and os.path.exists(manifest_path):
+        paths, labels, class_names = load_manifest(manifest_path, subset)
+    else:
+        paths, labels, class_names = list_directory(os.path.join(dataset_dir, subset))
+
+    if len(paths) == 0:
+        raise ValueError(f"subset {subset} doesn't contain any images")
+
+    dataset = create_dataset(paths, labels, subset, img_size, batch_size, cache_dir, shuffle, seed, augmentation)
+    return dataset, class_names
\ No newline at end of file
@@ -19,19 +19,20 @@ public class Ladybug : IImageGenerator<Ladybug> {
     private const string TRAINING_SCRIPT_PATH = @"ladybug\ModelTraining.py";
     private const string APPLICATION_SCRIPT_PATH = @"ladybug\ModelApplication.py";
 
+    /// <summary>
+    /// trains the model and waits until the training finishes
+    /// </summary>
+    /// <exception cref="PythonScriptException">the training script failed</exception>
     internal static void TrainModel() {
-        PythonWrapper.RunPythonScript(TRAINING_SCRIPT_PATH);
-        WaitForOutput();
+        PythonWorker.RunScript(TRAINING_SCRIPT_PATH, "--ipc");
     }
 
+    /// <summary>
+    /// runs the trained model and waits until the output image is saved
+    /// </summary>
+    /// <exception cref="PythonScriptException">the application script failed</exception>
     internal static void RunGenerator() {
-        PythonWrapper.RunPythonScript(APPLICATION_SCRIPT_PATH);
-        WaitForOutput();
-    }
-    private static void WaitForOutput() {
-        while (!File.Exists("DONE"))
-            Thread.Sleep(500);
-        File.Delete("DONE");
+        PythonWorker.RunScript(APPLICATION_SCRIPT_PATH, "--ipc");
     }
 
     public Bitmap GenerateImage() {
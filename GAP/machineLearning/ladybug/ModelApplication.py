@@ -10,23 +10,141 @@ import os
 os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
-import tensorflow as tf
-import tensorflow.keras as keras
 import numpy as np
 
 import sys, os
 sys.path.append(os.path.relpath(r"..\..\..\machinelearning\utils"))
 from ConsoleColors import *
+import MessageProtocol
+import Profiler
+import Progress
+import KerasArchive
+
+# when run by the C# host, the result is reported using the message protocol
+if "--ipc" in sys.argv[1:]:
+    MessageProtocol.start()
+
+# returns the value following the given command line argument
+def get_argument(name, default = ""):
+    return sys.argv[sys.argv.index(name) + 1] if name in sys.argv[1:-1] else default
+
+# the timing of each phase is written to the given file (see Profiler.py), "-" = stderr
+Profiler.configure(get_argument("--profile"))
 
 MODEL_PATH = r"..\..\..\machinelearning\ladybug"
 MODEL_NAME = "cnn_model.keras"
-OUTPUT_PATH = r"..\..\..\machinelearning\ladybug\output\output.png"
+OUTPUT_PATH = get_argument("--output", r"..\..\..\machinelearning\ladybug\output\output.png")
+
+# the default model can be replaced by any other using the --model argument
+MODEL_FILE = get_argument("--model", fr"{MODEL_PATH}\{MODEL_NAME}")
+
+# directory of the model exported using --export. it contains the already traced
+# functions, so keras doesn't have to build the model, which makes the startup
+# faster and takes less memory. when set, it's used instead of MODEL_FILE
+EXPORTED = get_argument("--exported")
 
-ITERATIONS = 100
+ITERATIONS = int(get_argument("--iterations", "100"))
 DISTORTION_RATE = 15
 
-def random_noise():
-    noise = np.random.random((1, 180, 180, 3))
+# number of images created at once from different random noise. they are all
+# optimized as a single batch, the outputs are numbered, e.g. output_0.png
+SEEDS = int(get_argument("--seeds", "1"))
+
+# the progress is only logged every LOG_EVERY iterations, since reading
+# the loss waits for the computation to finish
+LOG_EVERY = int(get_argument("--log-every", "10"))
+
+# optional image with all outputs arranged into a grid
+CONTACT_SHEET_PATH = get_argument("--contact-sheet")
+
+# the image starts at a lower resolution, which grows OCTAVE_SCALE times after each octave
+# until it reaches the size of the model input. the coarse structure is created first, the
+# details later. ITERATIONS is the maximum number of iterations in each octave
+OCTAVES = int(get_argument("--octaves", "1"))
+OCTAVE_SCALE = float(get_argument("--octave-scale", "1.4"))
+
+# the image is randomly shifted by up to JITTER pixels before each step,
+# which prevents the high-frequency noise the model reacts to the most
+JITTER = int(get_argument("--jitter", "0"))
+
+# regularization keeping the images smooth: the total variation is added to the loss
+# with the given weight, and the image is blurred every BLUR_EVERY iterations
+TV_WEIGHT = float(get_argument("--tv-weight", "0"))
+BLUR_SIGMA = float(get_argument("--blur-sigma", "0"))
+BLUR_EVERY = int(get_argument("--blur-every", "10"))
+
+# an octave ends early once the activation of all images gets below TARGET_ACTIVATION,
+# or when the loss improved by less than TOLERANCE since the last log (checked
+# every LOG_EVERY iterations, when the loss is read anyway)
+TARGET_ACTIVATION = float(get_argument("--target", "nan"))
+TOLERANCE = float(get_argument("--tolerance", "0"))
+
+# a fixed seed makes the starting noise (and so the output) reproducible
+if get_argument("--seed") != "":
+    np.random.seed(int(get_argument("--seed")))
+
+# validates the settings and the model file without importing tensorflow
+# or loading the model, returns the list of problems found
+def check():
+    problems = []
+    for name, value, minimum in [("iterations", ITERATIONS, 1), ("seeds", SEEDS, 1), ("log-every", LOG_EVERY, 1),
+                                 ("octaves", OCTAVES, 1), ("jitter", JITTER, 0), ("blur-every", BLUR_EVERY, 1)]:
+        if value < minimum:
+            problems.append(f"--{name} has to be at least {minimum}, got {value}")
+    if OCTAVE_SCALE <= 0:
+        problems.append(f"--octave-scale has to be positive, got {OCTAVE_SCALE}")
+
+    if EXPORTED != "":
+        if not os.path.isfile(os.path.join(EXPORTED, "saved_model.pb")):
+            problems.append(f"exported model {EXPORTED} doesn't exist")
+        return problems
+
+    if not os.path.isfile(MODEL_FILE):
+        return problems + [f"model {MODEL_FILE} doesn't exist"]
+
+    try:
+        input_shape = KerasArchive.get_input_shape(KerasArchive.read_config(MODEL_FILE))
+    except Exception as e:
+        return problems + [f"model {MODEL_FILE} can't be read: {type(e).__name__} {e}"]
+
+    if input_shape is None or len(input_shape) != 4 or input_shape[3] != 3:
+        problems.append(f"model {MODEL_FILE} doesn't take RGB images, its input shape is {input_shape}")
+    return problems
+
+if "--check" in sys.argv[1:]:
+    problems = check()
+    for problem in problems:
+        print(f"   {RED}{CIRCLE}{WHITE} {problem}")
+    if len(problems) > 0:
+        sys.exit(1)
+    print(f"Settings and model {MAGENTA}{os.path.basename(MODEL_FILE)}{WHITE} are valid.")
+    sys.exit()
+
+# tensorflow takes seconds to import, so the check above is done without it
+import tensorflow as tf
+import tensorflow.keras as keras
+
+# models trained before the augmentation was moved into the input pipeline contain
+# the random augmentation layers, which do nothing at inference, but still cost
+# time on every step. the model (a single chain of layers, as created by
+# ModelTraining.py) is rebuilt without them, sharing the trained weights
+def strip_augmentation(model):
+    model_layers = [layer for layer in model.layers if not isinstance(layer, keras.layers.InputLayer)]
+    if not any(type(layer).__name__.startswith("Random") for layer in model_layers):
+        return model
+
+    try:
+        input = keras.Input(shape = model.input_shape[1:])
+        x = input
+        for layer in model_layers:
+            if not type(layer).__name__.startswith("Random"):
+                x = layer(x)
+        return keras.Model(inputs = input, outputs = x)
+    except (ValueError, TypeError):
+        return model
+
+def random_noise(count, shape = (180, 180)):
+    noise = np.random.random((count, *shape, 3)).astype("float32")
     return tf.convert_to_tensor(noise)
 
 def preprocess_image(image_path):
@@ -35,58 +153,209 @@ def preprocess_image(image_path):
     img = np.expand_dims(img, axis = 0)
     return tf.convert_to_tensor(img)
 
-def save_image(img):
-    img = img.reshape((img.shape[1], img.shape[2], 3))
-    img /= 2.0
+# converts a single image from the batch into a savable form
+def deprocess_image(img):
+    img = img / 2.0
     img += 0.5
     img *= 255.0
-    img = np.clip(img, 0, 255).astype("uint8")
-    keras.utils.save_img(OUTPUT_PATH, img)
+    return np.clip(img, 0, 255).astype("uint8")
+
+# returns the output paths, with more seeds they are numbered after the seed
+def get_output_paths(count):
+    if count == 1:
+        return [OUTPUT_PATH]
+
+    stem, extension = os.path.splitext(OUTPUT_PATH)
+    return [f"{stem}_{i}{extension}" for i in range(count)]
+
+def save_images(img):
+    output_paths = get_output_paths(img.shape[0])
+    for i, output_path in enumerate(output_paths):
+        keras.utils.save_img(output_path, deprocess_image(img[i]))
+    return output_paths
 
+# arranges all images into a grid, as close to a square as possible
+def save_contact_sheet(img, path):
+    count, height, width, _ = img.shape
+    columns = int(np.ceil(np.sqrt(count)))
+    rows = int(np.ceil(count / columns))
+
+    sheet = np.zeros((rows * height, columns * width, 3), dtype = "uint8")
+    for i in range(count):
+        row, column = divmod(i, columns)
+        sheet[row * height : (row + 1) * height, column * width : (column + 1) * width] = deprocess_image(img[i])
+    keras.utils.save_img(path, sheet)
+
+# returns the loss and activation of each image in the batch
 def calculate_loss(image):
     activation = model(image)
 
-    loss = tf.zeros(shape=())
-    loss += tf.reduce_mean(activation)
-    return loss, activation
+    loss = tf.reduce_mean(activation, axis = list(range(1, len(activation.shape))))
+    return loss, activation[:, 0]
+
+# image, distortion rate, jitter and total variation weight. the image shape is
+# left unspecified, so the step is only traced once for all octaves
+STEP_SIGNATURE = [
+    tf.TensorSpec(shape = [None, None, None, 3], dtype = tf.float32),
+    tf.TensorSpec(shape = [], dtype = tf.float32),
+    tf.TensorSpec(shape = [], dtype = tf.int32),
+    tf.TensorSpec(shape = [], dtype = tf.float32)
+]
+
+# the whole step is compiled into a single graph, and all seeds are processed at once
+@tf.function(input_signature = STEP_SIGNATURE)
+def gradient_ascent_step(image, distortion_rate, jitter, tv_weight):
+    # shift the image randomly (jitter = 0 means no shift)
+    shift = tf.random.uniform([2], -jitter, jitter + 1, dtype = tf.int32)
+    image = tf.roll(image, shift, axis = [1, 2])
 
-def gradient_ascent_step(image, distortion_rate, i):
     # GradientTape record all tensor operations made with the image.
     # it is a very useful tool for automatic differentiation
     with tf.GradientTape() as tape:
         tape.watch(image)
-        loss, activation = calculate_loss(image)
+
+        # in the lower octaves, the image is smaller than the model input
+        loss, activation = calculate_loss(tf.image.resize(image, INPUT_SIZE))
+
+        # the total variation is normalized by the number of pixels, so
+        # the weight means the same in all octaves
+        pixels = tf.cast(tf.reduce_prod(tf.shape(image)[1:]), tf.float32)
+        regularization = tv_weight * tf.image.total_variation(image) / pixels
+
+        # the images don't affect each other, so the gradient of the summed loss is the
+        # gradient of each image's own loss. the sum has to be recorded by the tape too,
+        # otherwise the gradient is disconnected from the image (None)
+        total_loss = tf.reduce_sum(loss + regularization)
 
     # retroactively calculate the loss gradient with respect to the different parts of the image
-    gradients = tape.gradient(loss, image)
+    gradients = tape.gradient(total_loss, image)
 
     # without normalizing the gradients, layers with lower activations would become unnoticeable
-    gradients = tf.math.l2_normalize(gradients)
+    # (each image is normalized on its own, same as when it was optimized alone)
+    gradients = tf.math.l2_normalize(gradients, axis = [1, 2, 3])
 
     # update the image using the calculated gradients
     image += distortion_rate * -gradients
-    return loss, activation, image
+    return loss, activation, tf.roll(image, -shift, axis = [1, 2])
+
+def gaussian_kernel(sigma):
+    radius = max(1, int(np.ceil(3 * sigma)))
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-x ** 2 / (2 * sigma ** 2))
+    kernel = np.outer(kernel, kernel) / np.outer(kernel, kernel).sum()
+
+    # the same kernel for all three channels
+    return tf.constant(np.tile(kernel[:, :, np.newaxis, np.newaxis], (1, 1, 3, 1)), dtype = tf.float32)
+
+@tf.function(reduce_retracing = True)
+def blur(image, kernel):
+    return tf.nn.depthwise_conv2d(image, kernel, strides = [1, 1, 1, 1], padding = "SAME")
+
+# the resolutions of the octaves, the last one is the size of the model input
+def calculate_octave_shapes():
+    height, width = INPUT_SIZE
+    return [(int(height / OCTAVE_SCALE ** i), int(width / OCTAVE_SCALE ** i)) for i in range(OCTAVES)][::-1]
+
+# runs up to ITERATIONS steps, returns the image and the number of iterations done
+def gradient_ascent_loop(image, octave):
+    distortion_rate = tf.constant(DISTORTION_RATE, dtype = tf.float32)
+    jitter = tf.constant(JITTER, dtype = tf.int32)
+    tv_weight = tf.constant(TV_WEIGHT, dtype = tf.float32)
+    kernel = gaussian_kernel(BLUR_SIGMA) if BLUR_SIGMA > 0 else None
+    last_loss = None
 
-# loop repeats NUM_OCTAVE times with ITERATIONS steps
-def gradient_ascent_loop(image):
     for i in range(ITERATIONS):
-        loss, activation, image = gradient_ascent_step(image, DISTORTION_RATE, i)
-        print(f"{CYAN}Iteration {i + 1}/{ITERATIONS}{WHITE} - Loss: {loss:.5f}, Activation: {activation[0][0]:.5f}", end = "\r")
-    return image
+        loss, activation, image = gradient_ascent_step(image, distortion_rate, jitter, tv_weight)
+        if kernel is not None and (i + 1) % BLUR_EVERY == 0:
+            image = blur(image, kernel)
+
+        # only every LOG_EVERY iterations (and after the last one) the results are read back
+        if (i + 1) % LOG_EVERY == 0 or i + 1 == ITERATIONS:
+            loss, activation = loss.numpy(), activation.numpy()
+
+            Progress.update(f"{CYAN}Octave {octave + 1}/{OCTAVES}, Iteration {i + 1}/{ITERATIONS}{WHITE} - Loss: {loss.mean():.5f}, Activation: {activation.mean():.5f}",
+                            octave = octave + 1, iteration = i + 1, loss = float(loss.mean()), activation = float(activation.mean()))
+            MessageProtocol.send("progress", octave = octave + 1, iteration = i + 1, loss = loss.tolist(), activation = activation.tolist())
+
+            # stop early once the target is reached or the loss stops improving
+            # (the target is only checked in the last octave, which has the full resolution)
+            if octave + 1 == OCTAVES and np.all(activation < TARGET_ACTIVATION):
+                return image, i + 1, True
+            if TOLERANCE > 0 and last_loss is not None and np.all(last_loss - loss < TOLERANCE):
+                return image, i + 1, False
+            last_loss = loss
+    return image, ITERATIONS, False
+
+# optimizes the image octave by octave, returns the final
+# image and the total number of iterations done
+def optimize(count):
+    shapes = calculate_octave_shapes()
+    image = random_noise(count, shapes[0])
+
+    iterations = 0
+    for octave, shape in enumerate(shapes):
+        image = tf.image.resize(image, shape)
+        image, octave_iterations, reached = gradient_ascent_loop(image, octave)
+        iterations += octave_iterations
+        if reached:
+            break
+    return image, iterations
 
 print(f"Running Ladybug:")
 print(f"   {GREEN}{CIRCLE}{WHITE} Output path: {OUTPUT_PATH}")
-print(f"   {GREEN}{CIRCLE}{WHITE} Total iterations: {RED}{ITERATIONS}{WHITE}")
+print(f"   {GREEN}{CIRCLE}{WHITE} Seeds: {RED}{SEEDS}{WHITE}")
+print(f"   {GREEN}{CIRCLE}{WHITE} Octaves: {RED}{OCTAVES}{WHITE}")
+print(f"   {GREEN}{CIRCLE}{WHITE} Iterations per octave: {RED}{ITERATIONS}{WHITE}")
 print(f"   {GREEN}{CIRCLE}{WHITE} Distortion rate:  {RED}{DISTORTION_RATE}{WHITE}\n")
 
-model = keras.models.load_model(fr"{MODEL_PATH}\{MODEL_NAME}")
-print(f"Model {MAGENTA}{MODEL_NAME}{WHITE} loaded successfully.\n");
+# saves the model along with the compiled functions as a SavedModel, which can then be
+# used instead of the .keras model (see EXPORTED). the functions are also saved as
+# signatures, so the model can be used without python as well
+def export(export_dir):
+    exported = tf.Module()
+    exported.model = model
+    exported.input_size = tf.Variable(INPUT_SIZE, trainable = False)
+    exported.gradient_ascent_step = gradient_ascent_step
+    exported.calculate_loss = tf.function(calculate_loss, input_signature = [tf.TensorSpec(shape = [None, *INPUT_SIZE, 3], dtype = tf.float32)])
+
+    tf.saved_model.save(exported, export_dir, signatures = {
+        "gradient_ascent_step" : exported.gradient_ascent_step.get_concrete_function(),
+        "calculate_loss" : exported.calculate_loss.get_concrete_function()
+    })
+
+with Profiler.phase("model_load"):
+    if EXPORTED != "":
+        exported = tf.saved_model.load(EXPORTED)
+        INPUT_SIZE = tuple(exported.input_size.numpy().tolist())
+        gradient_ascent_step, calculate_loss = exported.gradient_ascent_step, exported.calculate_loss
+    else:
+        model = strip_augmentation(keras.models.load_model(MODEL_FILE))
+        INPUT_SIZE = tuple(model.input_shape[1:3])
+print(f"Model {MAGENTA}{os.path.basename(EXPORTED or MODEL_FILE)}{WHITE} loaded successfully.\n");
+
+if "--export" in sys.argv[1:-1]:
+    if EXPORTED != "":
+        sys.exit("only a .keras model can be exported, not an already exported one")
+    export(get_argument("--export"))
+    print(f"Model exported to: {YELLOW}{get_argument('--export')}{WHITE}\n")
+    MessageProtocol.send("result", outputs = [get_argument("--export")])
+    sys.exit()
+
+with Profiler.phase("generate", images = SEEDS) as fields:
+    output, fields["iterations"] = optimize(SEEDS)
+    output = output.numpy()
 
-noise = random_noise()
-output = gradient_ascent_loop(noise)
+# the final loss and activation, so different settings can be compared
+loss, activation = calculate_loss(tf.convert_to_tensor(output))
+Progress.stop()
+print(f"\nFinished after {RED}{fields['iterations']}{WHITE} iterations - Loss: {float(tf.reduce_mean(loss)):.5f}, Activation: {float(tf.reduce_mean(activation)):.5f}")
 
-save_image(output.numpy())
-print(f"\n\nOutput saved to: {YELLOW}{OUTPUT_PATH}{WHITE}\n")
+with Profiler.phase("save", images = SEEDS):
+    outputs = save_images(output)
+    if CONTACT_SHEET_PATH != "":
+        save_contact_sheet(output, CONTACT_SHEET_PATH)
+        outputs.append(CONTACT_SHEET_PATH)
+print(f"Output saved to: {YELLOW}{', '.join(outputs)}{WHITE}\n")
 
-f = open("DONE", "w")
-f.close()
\ No newline at end of file
+MessageProtocol.send("result", outputs = outputs, iterations = fields["iterations"],
+                     loss = loss.numpy().tolist(), activation = activation.numpy().tolist())
\ No newline at end of file
@@ -5,50 +5,170 @@
 #      founded 11.9.2024
 #
 
-# disable annoying warnings
-import os
-os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'
+import os, sys, json, time, random, pickle, shutil, argparse, subprocess
+
+# the best batch size and thread counts found by --autotune,
+# they are used as the defaults of the performance options
+AUTOTUNE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "autotune.json")
+
+# the options may also be set in a JSON config file passed using --config, e.g.
+#   {"dataset_dir": "D:\\datasets\\ladybug", "epochs": 50, "batch_size": 64}
+# the options given on the command line override the config file, which
+# overrides the autotuned options, which override the default values
+#
+# the performance options have to be known before tensorflow is imported
+def parse_args():
+    parser = argparse.ArgumentParser(description = "Trains the Ladybug model.")
+    parser.add_argument("--config", default = "", help = "JSON file with any of the options below")
+    parser.add_argument("--ipc", action = "store_true", help = "report the progress using the message protocol")
+    parser.add_argument("--dataset-dir", default = r"C:\Users\michn\Desktop\catsndawgs\train_modif",
+                        help = "directory with the subsets created by CreateSubsets.py")
+    parser.add_argument("--epochs", type = int, default = 3, help = "maximum number of epochs")
+    parser.add_argument("--patience", type = int, default = 5, help = "epochs without improvement before the training stops, 0 = never stop early")
+    parser.add_argument("--lr-patience", type = int, default = 2, help = "epochs without improvement before the learning rate is halved, 0 = never")
+    parser.add_argument("--restart", action = "store_true", help = "discard the saved training state instead of resuming from it")
+    parser.add_argument("--batch-size", type = int, default = 32)
+    parser.add_argument("--intra-threads", type = int, default = 0, help = "threads used by a single operation, 0 = all cores")
+    parser.add_argument("--inter-threads", type = int, default = 0, help = "operations run in parallel, 0 = automatic")
+    parser.add_argument("--no-onednn", action = "store_true", help = "disable the oneDNN optimized CPU kernels")
+    parser.add_argument("--mixed-precision", action = "store_true", help = "compute in bfloat16, keep the weights in float32")
+    parser.add_argument("--jit-compile", action = "store_true", help = "compile the training step using XLA")
+    parser.add_argument("--autotune", action = "store_true", help = "find the fastest batch size and thread counts for this machine")
+    parser.add_argument("--check", action = "store_true", help = "only validate the options and the dataset, without training")
+
+    # used by --autotune, measures the training speed of a single configuration
+    parser.add_argument("--measure-steps", type = int, default = 0, help = argparse.SUPPRESS)
+
+    if os.path.exists(AUTOTUNE_PATH):
+        with open(AUTOTUNE_PATH) as file:
+            parser.set_defaults(**json.load(file))
+
+    config_path = parser.parse_known_args()[0].config
+    if config_path != "":
+        with open(config_path) as file:
+            config = json.load(file)
+
+        known_options = set(vars(parser.parse_known_args([])[0]))
+        unknown_options = set(config) - known_options
+        if len(unknown_options) > 0:
+            parser.error(f"unknown options in {config_path}: {', '.join(sorted(unknown_options))}")
+        parser.set_defaults(**config)
+    return parser.parse_args()
+
+ARGS = parse_args()
+
+# validates the options and the dataset without importing tensorflow,
+# returns the list of problems found
+def check():
+    problems = []
+    for name in ("epochs", "batch_size"):
+        if getattr(ARGS, name) < 1:
+            problems.append(f"--{name.replace('_', '-')} has to be at least 1, got {getattr(ARGS, name)}")
+
+    if not os.path.isdir(ARGS.dataset_dir):
+        return problems + [f"dataset directory {ARGS.dataset_dir} doesn't exist"]
+
+    # the manifest is preferred, the subset directories are only needed without it
+    if not os.path.exists(os.path.join(ARGS.dataset_dir, "manifest.csv")):
+        for subset in ("train", "validation", "test"):
+            if not os.path.isdir(os.path.join(ARGS.dataset_dir, subset)):
+                problems.append(f"subset {subset} doesn't exist, create it using CreateSubsets.py")
+    return problems
+
+if ARGS.check:
+    problems = check()
+    for problem in problems:
+        print(f"   - {problem}")
+    if len(problems) > 0:
+        sys.exit(1)
+    print("Options and dataset are valid.")
+    sys.exit()
+
+# oneDNN used to be disabled only to get rid of its startup message
+# it makes the training on CPU a lot faster, so it's only disabled on request
+os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0' if ARGS.no_onednn else '1'
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
 import pathlib
+import numpy as np
+import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras import layers
-from tensorflow.keras.utils import image_dataset_from_directory
 
-import sys, os
+# the thread pools can only be set up before tensorflow runs anything
+tf.config.threading.set_intra_op_parallelism_threads(ARGS.intra_threads)
+tf.config.threading.set_inter_op_parallelism_threads(ARGS.inter_threads)
+
+# bfloat16 is used instead of float16, since it has the same range as float32 (no loss
+# scaling needed) and modern CPUs support it natively. the output stays in float32
+if ARGS.mixed_precision:
+    keras.mixed_precision.set_global_policy("mixed_bfloat16")
+
 sys.path.append(os.path.relpath(r"..\..\..\machinelearning\utils"))
 from ConsoleColors import *
+import MessageProtocol
+import DataPipeline
 
-DATASET_DIR = pathlib.Path(r"C:\Users\michn\Desktop\catsndawgs\train_modif")
+# when run by the C# host, the progress and result are reported using the message protocol
+if ARGS.ipc:
+    MessageProtocol.start()
+
+DATASET_DIR = pathlib.Path(ARGS.dataset_dir)
 MODEL_PATH = r"..\..\..\machinelearning\ladybug"
 MODEL_NAME = "cnn_model.keras"
 
+# the whole training state (weights, optimizer, epoch, random generators, early
+# stopping) is saved here after every epoch, so an interrupted training resumes
+# where it stopped. the state is deleted once the training finishes
+BACKUP_DIR = r"..\..\..\machinelearning\ladybug\backup"
+
+# the subsets are read from the manifest written by CreateSubsets.py, or from the
+# subset directories if there's no manifest. the decoded images are cached in
+# CACHE_DIR, so they're only decoded once (empty = cache in memory for one run)
+MANIFEST_PATH = DATASET_DIR / "manifest.csv"
+CACHE_DIR = r"..\..\..\machinelearning\ladybug\cache"
+SEED = 42
+
 IMG_SIZE = 180
-BATCH_SIZE = 32
-EPOCHS = 3
+BATCH_SIZE = ARGS.batch_size
+EPOCHS = ARGS.epochs
+
+# configurations tried by --autotune, 0 threads = decided by tensorflow
+AUTOTUNE_BATCH_SIZES = [16, 32, 64, 128]
+AUTOTUNE_THREADS = list(dict.fromkeys([(0, 0), (os.cpu_count(), 1), (os.cpu_count(), 2), (max(1, os.cpu_count() // 2), 2)]))
+AUTOTUNE_WARMUP_STEPS = 5
+AUTOTUNE_STEPS = 20
+
+# augmentation of the training images (see DataPipeline.create_augmentation),
+# None disables the given augmentation
+AUGMENT_FLIP = "horizontal"
+AUGMENT_ROTATION = 0.1
+AUGMENT_ZOOM = 0.2
 
 # expects the subsets already exist
-# if they don't, create them using DataSubsets.py
-def load_subsets():
-    global train_dataset, validation_dataset, test_dataset
-    
-    train_dataset = image_dataset_from_directory(DATASET_DIR / "train", image_size = (IMG_SIZE, IMG_SIZE), batch_size = BATCH_SIZE)
-    print(f"\033[F\033[44G ... subset {GREEN}train{WHITE} loaded correctly")
+# if they don't, create them using CreateSubsets.py
+def load_subset(subset, shuffle = False, augmentation = None):
+    dataset, class_names = DataPipeline.load_subset(DATASET_DIR, subset, IMG_SIZE, BATCH_SIZE, MANIFEST_PATH,
+                                                    CACHE_DIR, shuffle = shuffle, seed = SEED, augmentation = augmentation)
+    print(f"   ... subset {GREEN}{subset}{WHITE} loaded correctly (classes: {', '.join(class_names)})")
+    return dataset
 
-    validation_dataset = image_dataset_from_directory(DATASET_DIR / "validation", image_size = (IMG_SIZE, IMG_SIZE), batch_size = BATCH_SIZE)
-    print(f"\033[F\033[44G ... subset {GREEN}validation{WHITE} loaded correctly")
+def load_subsets():
+    global train_dataset, validation_dataset, test_dataset, augmentation
 
-    test_dataset = image_dataset_from_directory(DATASET_DIR / "test", image_size = (IMG_SIZE, IMG_SIZE), batch_size = BATCH_SIZE)
-    print(f"\033[F\033[44G ... subset {GREEN}test{WHITE} loaded correctly\n")
+    # only the training images are augmented
+    augmentation = DataPipeline.create_augmentation(AUGMENT_FLIP, AUGMENT_ROTATION, AUGMENT_ZOOM, seed = SEED)
+    train_dataset = load_subset("train", shuffle = True, augmentation = augmentation)
+    validation_dataset = load_subset("validation")
+    test_dataset = load_subset("test")
+    print()
 
 def create_model():
     input = keras.Input(shape = (IMG_SIZE, IMG_SIZE, 3))
 
-    # data augmentation part
-    x = layers.RandomFlip("horizontal")(input)
-    x = layers.RandomRotation(0.1)(x)
-    x = layers.RandomZoom(0.2)(x)
-    x = layers.Rescaling(1.0 / 255)(x)
+    # the data augmentation is a part of the input pipeline, so the
+    # model (and the saved model used for inference) doesn't contain it
+    x = layers.Rescaling(1.0 / 255)(input)
 
     # convolutional base part
     x = layers.Conv2D(filters = 32, kernel_size = 3, activation = "relu")(x)
@@ -69,32 +189,191 @@ def create_model():
     x = layers.Flatten()(x)
     x = layers.Dropout(0.5)(x)
 
-    output = layers.Dense(1, activation = "sigmoid")(x)
+    # the output is kept in float32 even with mixed precision, so the loss is numerically stable
+    output = layers.Dense(1, activation = "sigmoid", dtype = "float32")(x)
     return keras.Model(inputs = input, outputs = output)
 
+# saves and restores the part of the training state BackupAndRestore doesn't
+# cover: the random generators (including the seed generators of the augmentation
+# layers, which don't use the global ones) and the progress of the callbacks waiting
+# for an improvement (otherwise their patience would start over after resuming).
+# the best loss seen by the model checkpoint is kept as well, otherwise the first
+# epoch after resuming would overwrite a better model, and so are the best weights
+# of the early stopping, which it goes back to once it stops
+TRAINING_STATE_PATH = os.path.join(BACKUP_DIR, "training_state.pkl")
+CALLBACK_STATE = ("wait", "best", "best_epoch", "best_weights", "cooldown_counter")
+
+# the state of each callback is saved under the name of its class,
+# so it's restored correctly even when some callbacks are disabled
+def get_callback_state(callback):
+    return {name : getattr(callback, name) for name in CALLBACK_STATE if hasattr(callback, name)}
+
+def restore_training_state(callbacks):
+    if not os.path.exists(TRAINING_STATE_PATH):
+        return
+
+    with open(TRAINING_STATE_PATH, "rb") as file:
+        state = pickle.load(file)
+
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    tf.random.get_global_generator().reset(state["tensorflow"])
+    # states saved without the augmentation (or with a different one) are skipped
+    augmentation_state = state.get("augmentation", [])
+    if augmentation is not None and len(augmentation_state) == len(augmentation.variables):
+        for variable, value in zip(augmentation.variables, augmentation_state):
+            variable.assign(value)
+    # states saved by older versions are a list, they can't be matched to the callbacks
+    callback_states = state["callbacks"] if isinstance(state["callbacks"], dict) else dict()
+    for callback in callbacks:
+        for name, value in callback_states.get(type(callback).__name__, dict()).items():
+            setattr(callback, name, value)
+    print(f"Resuming the training from the saved state\n")
+
+def save_training_state(callbacks):
+    state = {
+        "python" : random.getstate(),
+        "numpy" : np.random.get_state(),
+        "tensorflow" : tf.random.get_global_generator().state.numpy(),
+        "augmentation" : [variable.numpy() for variable in augmentation.variables] if augmentation is not None else [],
+        "callbacks" : {type(callback).__name__ : get_callback_state(callback) for callback in callbacks}
+    }
+
+    os.makedirs(BACKUP_DIR, exist_ok = True)
+    with open(f"{TRAINING_STATE_PATH}.tmp", "wb") as file:
+        pickle.dump(state, file)
+    os.replace(f"{TRAINING_STATE_PATH}.tmp", TRAINING_STATE_PATH)
+
+def delete_training_state():
+    if os.path.exists(TRAINING_STATE_PATH):
+        os.remove(TRAINING_STATE_PATH)
+
+def compile_model(model):
+    model.compile(loss = "binary_crossentropy", optimizer = "rmsprop", metrics = ["accuracy"], jit_compile = ARGS.jit_compile)
+
 def train_model():
    return model.fit(train_dataset, epochs = EPOCHS, validation_data = validation_dataset, callbacks = callbacks)
 
+# measures how many images per second the model trains on with the current options. random
+# images are used, so only the training step itself is measured, not the input pipeline
+def measure_speed():
+    images = np.random.default_rng(SEED).uniform(0, 255, (BATCH_SIZE, IMG_SIZE, IMG_SIZE, 3)).astype("float32")
+    labels = np.random.default_rng(SEED).integers(0, 2, (BATCH_SIZE,))
+    dataset = tf.data.Dataset.from_tensors((images, labels)).repeat()
+
+    model = create_model()
+    compile_model(model)
+
+    times = []
+    timer = keras.callbacks.LambdaCallback(
+        on_train_batch_begin = lambda batch, logs: times.append(time.perf_counter()),
+        on_train_batch_end = lambda batch, logs: times.append(time.perf_counter()))
+    model.fit(dataset, steps_per_epoch = AUTOTUNE_WARMUP_STEPS + AUTOTUNE_STEPS, epochs = 1, callbacks = [timer], verbose = 0)
+
+    # the warmup steps (including the tracing and compilation) aren't counted
+    elapsed = times[-1] - times[2 * AUTOTUNE_WARMUP_STEPS]
+    return AUTOTUNE_STEPS * BATCH_SIZE / elapsed
+
+# each configuration is measured in a separate process, since the thread
+# pools can't be changed once tensorflow has started
+def autotune():
+    results = []
+    for batch_size in AUTOTUNE_BATCH_SIZES:
+        for intra_threads, inter_threads in AUTOTUNE_THREADS:
+            config = {"batch_size" : batch_size, "intra_threads" : intra_threads, "inter_threads" : inter_threads}
+            args = [sys.executable, os.path.abspath(__file__), "--measure-steps", str(AUTOTUNE_STEPS)]
+            for name, value in config.items():
+                args += [f"--{name.replace('_', '-')}", str(value)]
+            args += [option for option, enabled in [("--no-onednn", ARGS.no_onednn), ("--mixed-precision", ARGS.mixed_precision),
+                                                     ("--jit-compile", ARGS.jit_compile)] if enabled]
+
+            process = subprocess.run(args, stdout = subprocess.PIPE, text = True)
+            if process.returncode != 0:
+                print(f"   {RED}{CIRCLE}{WHITE} {config}: failed")
+                continue
+
+            speed = json.loads(process.stdout.strip().splitlines()[-1])["images_per_second"]
+            print(f"   {GREEN}{CIRCLE}{WHITE} {config}: {CYAN}{speed:.1f}{WHITE} images/s")
+            results.append((speed, config))
+
+    if len(results) == 0:
+        sys.exit("all configurations failed")
+
+    speed, config = max(results, key = lambda result: result[0])
+    with open(AUTOTUNE_PATH, "w") as file:
+        json.dump(config, file, indent = 2)
+    print(f"\nThe fastest configuration {config} ({speed:.1f} images/s) was saved to {AUTOTUNE_PATH}")
+
+if ARGS.measure_steps > 0:
+    AUTOTUNE_STEPS = ARGS.measure_steps
+    print(json.dumps({"images_per_second" : measure_speed()}))
+    sys.exit()
+
+if ARGS.autotune:
+    print(f"\nAutotuning Ladybug training:")
+    autotune()
+    sys.exit()
+
 print(f"\nStarting Ladybug training cycle:")
 print(f"   {GREEN}{CIRCLE}{WHITE} Epochs: {RED}{EPOCHS}{WHITE}")
-print(f"   {GREEN}{CIRCLE}{WHITE} Batch size: {RED}{BATCH_SIZE}{WHITE}\n")
+print(f"   {GREEN}{CIRCLE}{WHITE} Batch size: {RED}{BATCH_SIZE}{WHITE}")
+print(f"   {GREEN}{CIRCLE}{WHITE} Threads: {RED}{ARGS.intra_threads or 'auto'}{WHITE} intra-op, {RED}{ARGS.inter_threads or 'auto'}{WHITE} inter-op")
+print(f"   {GREEN}{CIRCLE}{WHITE} Precision: {RED}{keras.mixed_precision.global_policy().name}{WHITE}, XLA: {RED}{ARGS.jit_compile}{WHITE}\n")
+
+if ARGS.restart and os.path.exists(BACKUP_DIR):
+    shutil.rmtree(BACKUP_DIR)
+
+# the same starting weights and data order on every run
+keras.utils.set_random_seed(SEED)
 
 load_subsets()
 
 model = create_model()
 
-model.compile(loss = "binary_crossentropy", optimizer = "rmsprop", metrics = ["accuracy"])
+compile_model(model)
+
+# stop when the validation loss doesn't improve for a while, going back to the best
+# weights, and lower the learning rate when it doesn't improve for a shorter while
+plateau_callbacks = []
+if ARGS.patience > 0:
+    plateau_callbacks.append(keras.callbacks.EarlyStopping(monitor = "val_loss", patience = ARGS.patience, restore_best_weights = True))
+if ARGS.lr_patience > 0:
+    plateau_callbacks.append(keras.callbacks.ReduceLROnPlateau(monitor = "val_loss", factor = 0.5, patience = ARGS.lr_patience, min_lr = 1e-6))
 
 # auto-save for the model
+checkpoint_callback = keras.callbacks.ModelCheckpoint(
+    filepath = fr"{MODEL_PATH}\{MODEL_NAME}",
+
+    # only save the best version of the model (don't overwrite an older but better one)
+    # how good a model is is measured using the validation loss
+    save_best_only = True,
+    monitor = "val_loss"
+)
+
+# callbacks whose state is saved for resuming (see save_training_state)
+stateful_callbacks = [*plateau_callbacks, checkpoint_callback]
+
 callbacks = [
-    keras.callbacks.ModelCheckpoint(
-        filepath = fr"{MODEL_PATH}\{MODEL_NAME}",
+    # restores the weights, optimizer and epoch of an interrupted training
+    keras.callbacks.BackupAndRestore(backup_dir = BACKUP_DIR),
+
+    *plateau_callbacks,
+
+    checkpoint_callback,
+
+    # report the metrics after each epoch
+    keras.callbacks.LambdaCallback(
+        on_epoch_end = lambda epoch, logs: MessageProtocol.send("progress", epoch = epoch + 1, epochs = EPOCHS,
+                                                                **{name : float(value) for name, value in logs.items()})
+    ),
 
-        # only save the best version of the model (don't overwrite an older but better one)
-        # how good a model is is measured using the validation loss
-        save_best_only = True,
-        monitor = "val_loss"
-)]
+    # saved last, after the other callbacks have updated their state for the epoch
+    keras.callbacks.LambdaCallback(
+        on_train_begin = lambda logs: restore_training_state(stateful_callbacks),
+        on_epoch_end = lambda epoch, logs: save_training_state(stateful_callbacks),
+        on_train_end = lambda logs: delete_training_state()
+    )
+]
 
 # training data is saved to history in case someone wants to view it
 history = train_model()
@@ -109,5 +388,4 @@ print(f"   {GREEN}{CIRCLE}{WHITE} Testing accuracy: {CYAN}{test_acc:.3f}{WHITE}\
 #test_loss, test_acc = test_model.evaluate(test_dataset)
 #print(f"test loss: {test_loss:.3f}\ntest accuracy: {test_acc:.3f}")
 
-f = open(r"DONE", "w")
-f.close()
\ No newline at end of file
+MessageProtocol.send("result", outputs = [fr"{MODEL_PATH}\{MODEL_NAME}"], test_loss = test_loss, test_accuracy = test_acc)
\ No newline at end of file
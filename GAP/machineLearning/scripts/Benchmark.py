@@ -0,0 +1,382 @@
+#
+# GAP - Generative Art Producer
+#   by ZlomenyMesic & KryKom
+#
+#      founded 11.9.2024
+#
+
+# THIS SCRIPT MEASURES THE PERFORMANCE OF DEEPDREAM AND LADYBUG
+#
+# both generators are run headless and offline (the model weights are loaded
+# from a local file and the inputs are either synthetic or bundled), over a
+# small matrix of resolutions, octave counts and layer sets. each DeepDream
+# case is measured twice:
+#   cold - the first job of a freshly started worker, including the model
+#          loading and the tracing of the compiled functions
+#   warm - the same job sent again to the already warmed up worker
+#
+# the timings come from the profile each script writes (see Profiler.py) and
+# are saved into a JSON report, which can later be used as a baseline:
+#   python Benchmark.py --weights inception_v3_notop.h5 --report baseline.json
+#   python Benchmark.py --weights inception_v3_notop.h5 --baseline baseline.json
+# when any metric gets worse than the baseline by more than the tolerance, the
+# regressions are printed and the script exits with a non-zero code. so does
+# it when a case fails, the results of the other cases are still saved
+
+import sys, os, json, time, platform, argparse, statistics, subprocess, tempfile
+import numpy as np
+from PIL import Image
+
+ML_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UTILS_DIR = os.path.join(ML_DIR, "utils")
+DEEPDREAM_SCRIPT = os.path.join(ML_DIR, "deepdream", "DeepDream.py")
+LADYBUG_SCRIPT = os.path.join(ML_DIR, "ladybug", "ModelApplication.py")
+BUNDLED_INPUT = os.path.join(ML_DIR, "deepdream", "input.jpg")
+
+# keras saves the downloaded weights here, so once DeepDream has been run
+# online, the benchmark can also use them offline
+DEFAULT_WEIGHTS = os.path.join(os.path.expanduser("~"), ".keras", "models",
+                               "inception_v3_weights_tf_dim_ordering_tf_kernels_notop.h5")
+DEFAULT_LADYBUG_MODEL = os.path.join(ML_DIR, "ladybug", "cnn_model.keras")
+
+# the benchmark matrix
+INPUTS = ["synthetic", "bundled"]
+RESOLUTIONS = [(256, 256), (512, 512)]
+OCTAVES = [1, 3]
+LAYER_SETS = [["mixed3"], ["mixed3", "mixed5"]]
+
+ITERATIONS = 10
+LADYBUG_ITERATIONS = 50
+SEED = 42
+
+# metrics where a higher value is better, all the other ones are times and memory
+HIGHER_IS_BETTER = {"iterations_per_second", "warm_iterations_per_second"}
+
+# creates the input image of the given kind and resolution. the synthetic image
+# is a seeded mix of gradients and noise, so it's the same on every machine
+def create_input(kind, resolution, directory):
+    height, width = resolution
+    path = os.path.join(directory, f"{kind}_{width}x{height}.png")
+    if os.path.exists(path):
+        return path
+
+    if kind == "bundled":
+        with Image.open(BUNDLED_INPUT) as image:
+            image.convert("RGB").resize((width, height), Image.LANCZOS).save(path)
+    else:
+        rng = np.random.default_rng(SEED)
+        y, x = np.mgrid[0 : height, 0 : width]
+        gradient = np.stack([x / width, y / height, (x + y) / (width + height)], axis = -1)
+        img = 0.6 * gradient + 0.4 * rng.random((height, width, 3))
+        Image.fromarray((img * 255).astype("uint8")).save(path)
+    return path
+
+# environment of the benchmarked scripts. the utils are added to the path,
+# so the scripts can be run from any directory
+def create_environment():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [UTILS_DIR, env.get("PYTHONPATH")]))
+    env["PYTHONHASHSEED"] = str(SEED)
+    env["TF_CPP_MIN_LOG_LEVEL"] = "2"
+    return env
+
+# reads the phases written by Profiler.py
+def read_profile(path):
+    if not os.path.exists(path):
+        return []
+
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip() != ""]
+
+# splits the phases by the job they belong to. a job phase is written when the
+# job finishes, so all phases before it (and after the previous job) are its own
+def split_jobs(phases):
+    jobs, current = dict(), []
+    for phase in phases:
+        if phase.get("event") != "phase":
+            continue
+        current.append(phase)
+        if phase["name"] == "job":
+            jobs[phase.get("id")] = current
+            current = []
+    return jobs
+
+def iterations_per_second(phases):
+    octaves = [phase for phase in phases if phase["name"] == "octave"]
+    wall = sum(phase["wall"] for phase in octaves)
+    return sum(phase["iterations"] for phase in octaves) / wall if wall > 0 else None
+
+def peak_memory(phases):
+    peaks = [phase["peak_memory"] for phase in phases if phase.get("peak_memory") is not None]
+    return max(peaks) if len(peaks) > 0 else None
+
+# starts DeepDream in worker mode (see run_worker in DeepDream.py)
+def start_worker(weights, profile_path, log):
+    process = subprocess.Popen(
+        [sys.executable, DEEPDREAM_SCRIPT, "--worker", "--weights", weights, "--profile", profile_path],
+        stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = log,
+        env = create_environment(), cwd = os.path.dirname(profile_path), text = True)
+    receive(process, "ready")
+    return process
+
+# reads the messages of the worker until one of the given type arrives
+def receive(process, message_type):
+    for line in process.stdout:
+        message = json.loads(line)
+        if message["type"] == message_type:
+            return message
+        if message["type"] == "error":
+            raise RuntimeError(f"DeepDream failed: {message['message']}\n{message.get('traceback', '')}")
+    raise RuntimeError(f"DeepDream exited with code {process.wait()} (see the log)")
+
+# runs a single job and returns the time reported by the worker
+def run_job(process, id, params):
+    process.stdin.write(json.dumps({"type" : "job", "id" : id, "params" : params}) + "\n")
+    process.stdin.flush()
+    return receive(process, "result")["time"]
+
+def stop_worker(process):
+    if process.poll() is None:
+        process.stdin.write(json.dumps({"type" : "exit"}) + "\n")
+        process.stdin.close()
+    process.wait()
+
+def create_job_params(img_path, output_path, octaves, layers):
+    return {
+        "VERBOSE" : False,
+        "IMG_NAME" : os.path.basename(img_path),
+        "IMG_ORIGIN" : img_path,
+        "IMG_ORIGIN_FORMAT" : 0,
+        "OUTPUT_PATH" : output_path,
+        "DISTORTION_RATE" : 20.0,
+        "OCTAVES" : octaves,
+        "OCT_SCALE" : 1.3,
+        "ITERATIONS" : ITERATIONS,
+        "MAX_LOSS" : 2147483647.0,
+        "LAYERS" : layers,
+        "LAYER_ACTIVATIONS" : [1] * len(layers)
+    }
+
+# runs a single DeepDream case in a fresh worker, first cold and then warm
+def benchmark_dream(case_dir, img_path, octaves, layers, args, log):
+    profile_path = os.path.join(case_dir, "profile.jsonl")
+    params = create_job_params(img_path, os.path.join(case_dir, "dream.png"), octaves, layers)
+
+    start = time.perf_counter()
+    worker = start_worker(args.weights, profile_path, log)
+    try:
+        startup = time.perf_counter() - start
+        cold_time = run_job(worker, "cold", params)
+        warm = [(f"warm_{i}", run_job(worker, f"warm_{i}", params)) for i in range(args.repeats)]
+    finally:
+        stop_worker(worker)
+
+    phases = [phase for phase in read_profile(profile_path) if phase.get("event") == "phase"]
+    jobs = split_jobs(phases)
+    model_load = [phase["wall"] for phase in phases if phase["name"] == "model_load"]
+
+    return {
+        "startup" : startup,
+        "model_load" : model_load[0] if len(model_load) > 0 else None,
+        "cold_job" : cold_time,
+        "warm_job" : statistics.median(warm_time for _, warm_time in warm),
+        "iterations_per_second" : iterations_per_second(jobs.get("cold", [])),
+        "warm_iterations_per_second" : statistics.median(iterations_per_second(jobs.get(id, [])) or 0 for id, _ in warm),
+        "peak_memory" : peak_memory(phases)
+    }
+
+# runs Ladybug, every run is a fresh process (the script doesn't have a worker mode)
+def benchmark_ladybug(case_dir, args, log):
+    results = []
+    for i in range(args.repeats):
+        profile_path = os.path.join(case_dir, f"profile_{i}.jsonl")
+        start = time.perf_counter()
+        subprocess.run([sys.executable, LADYBUG_SCRIPT, "--model", args.ladybug_model, "--profile", profile_path,
+                        "--output", os.path.join(case_dir, "output.png"), "--iterations", str(LADYBUG_ITERATIONS),
+                        "--seed", str(SEED)],
+                       stdout = log, stderr = log, env = create_environment(), cwd = case_dir, check = True)
+        total = time.perf_counter() - start
+
+        phases = {phase["name"] : phase for phase in read_profile(profile_path) if phase.get("event") == "phase"}
+        results.append({
+            "total" : total,
+            "model_load" : phases["model_load"]["wall"],
+            "generate" : phases["generate"]["wall"],
+            "iterations_per_second" : phases["generate"]["iterations_per_second"],
+            "peak_memory" : phases["save"]["peak_memory"]
+        })
+
+    # the median of each metric, so a single slow run doesn't skew the results
+    return {name : statistics.median(result[name] for result in results if result[name] is not None)
+            if any(result[name] is not None for result in results) else None for name in results[0]}
+
+# runs a single case and returns its results, None when it fails. a failing
+# case is recorded in failed, so it doesn't throw away the results of the others.
+# the end of the log is printed, as the temporary work directory is deleted
+def run_case(name, failed, log, benchmark, *benchmark_args):
+    print(f"Running {name}")
+    try:
+        return benchmark(*benchmark_args, log)
+    except (RuntimeError, OSError, subprocess.CalledProcessError) as e:
+        if isinstance(e, subprocess.CalledProcessError):
+            failed[name] = f"{os.path.basename(e.cmd[1])} exited with code {e.returncode}"
+        else:
+            failed[name] = str(e).splitlines()[0] if str(e) != "" else type(e).__name__
+        print(f"   {name} failed: {failed[name]}")
+
+        log.flush()
+        with open(log.name) as file:
+            for line in file.read().splitlines()[-10:]:
+                print(f"      {line}")
+        return None
+
+def run_benchmarks(args, work_dir, failed):
+    cases = dict()
+    log_path = os.path.join(work_dir, "benchmark.log")
+    with open(log_path, "w") as log:
+        for kind in INPUTS:
+            for resolution in RESOLUTIONS:
+                img_path = create_input(kind, resolution, work_dir)
+                for octaves in OCTAVES:
+                    for layers in LAYER_SETS:
+                        name = f"deepdream/{kind}/{resolution[1]}x{resolution[0]}/octaves={octaves}/{'+'.join(layers)}"
+                        if args.filter not in name:
+                            continue
+
+                        case_dir = os.path.join(work_dir, name.replace("/", "_").replace("=", ""))
+                        os.makedirs(case_dir, exist_ok = True)
+                        cases[name] = run_case(name, failed, log, benchmark_dream, case_dir, img_path, octaves, layers, args)
+
+        name = "ladybug/noise/180x180"
+        if args.filter in name:
+            if os.path.exists(args.ladybug_model):
+                case_dir = os.path.join(work_dir, "ladybug")
+                os.makedirs(case_dir, exist_ok = True)
+                cases[name] = run_case(name, failed, log, benchmark_ladybug, case_dir, args)
+            else:
+                print(f"Skipping {name}, the model {args.ladybug_model} doesn't exist")
+    return {name : case for name, case in cases.items() if case is not None}
+
+def create_report(cases, failed, args):
+    return {
+        "created" : time.strftime("%Y-%m-%d %H:%M:%S"),
+        "machine" : {
+            "platform" : platform.platform(),
+            "processor" : platform.processor(),
+            "cpu_count" : os.cpu_count(),
+            "python" : platform.python_version()
+        },
+        "settings" : {
+            "iterations" : ITERATIONS,
+            "ladybug_iterations" : LADYBUG_ITERATIONS,
+            "repeats" : args.repeats,
+            "seed" : SEED
+        },
+        "cases" : cases,
+        "failed" : failed
+    }
+
+def format_value(name, value):
+    if value is None:
+        return "-"
+    if "memory" in name:
+        return f"{value / 1024 / 1024:.0f} MB"
+    if "per_second" in name:
+        return f"{value:.2f}/s"
+    return f"{value:.2f} s"
+
+# the report as a markdown table, one row per case
+def format_report(report):
+    metrics = []
+    for case in report["cases"].values():
+        metrics += [name for name in case if name not in metrics]
+
+    lines = [f"| case | {' | '.join(metrics)} |", f"|---|{'---|' * len(metrics)}"]
+    for name, case in report["cases"].items():
+        lines.append(f"| {name} | {' | '.join(format_value(metric, case.get(metric)) for metric in metrics)} |")
+    return "\n".join(lines)
+
+# returns the metrics which got worse than in the baseline by more than the tolerance
+def compare(report, baseline, tolerance):
+    regressions = []
+    for name, case in report["cases"].items():
+        baseline_case = baseline["cases"].get(name)
+        if baseline_case is None:
+            continue
+
+        for metric, value in case.items():
+            old_value = baseline_case.get(metric)
+            if value is None or old_value is None or old_value == 0:
+                continue
+
+            change = (value - old_value) / old_value
+            if metric in HIGHER_IS_BETTER:
+                change = -change
+            if change > tolerance:
+                regressions.append((name, metric, old_value, value, change))
+    return regressions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = "Measures the performance of DeepDream and Ladybug.")
+    parser.add_argument("--weights", default = DEFAULT_WEIGHTS, help = "local InceptionV3 weights file (without the top)")
+    parser.add_argument("--ladybug-model", default = DEFAULT_LADYBUG_MODEL, help = "Ladybug model, skipped when it doesn't exist")
+    parser.add_argument("--repeats", type = int, default = 3, help = "number of warm runs of each case")
+    parser.add_argument("--filter", default = "", help = "only run the cases containing this text")
+    parser.add_argument("--work-dir", default = "", help = "directory for the inputs, outputs and profiles (temporary by default)")
+    parser.add_argument("--report", default = "benchmark.json", help = "file the JSON report is saved to")
+    parser.add_argument("--markdown", default = "", help = "file the markdown table is saved to")
+    parser.add_argument("--baseline", default = "", help = "report to compare the results against")
+    parser.add_argument("--tolerance", type = float, default = 0.15, help = "allowed relative regression (0.15 = 15 %%)")
+    args = parser.parse_args()
+
+    # the statistics of the warm runs need at least one of them
+    if args.repeats < 1:
+        parser.error(f"--repeats has to be at least 1, got {args.repeats}")
+    return args
+
+def main():
+    args = parse_args()
+
+    # the scripts run in their own working directories
+    args.weights = os.path.abspath(args.weights)
+    args.ladybug_model = os.path.abspath(args.ladybug_model)
+    args.work_dir = os.path.abspath(args.work_dir) if args.work_dir != "" else ""
+    if not os.path.exists(args.weights):
+        sys.exit(f"The weights file {args.weights} doesn't exist, the benchmark is meant to be run offline.\n"
+                 f"Run DeepDream once with an internet connection or pass the path using --weights.")
+
+    failed = dict()
+    if args.work_dir != "":
+        os.makedirs(args.work_dir, exist_ok = True)
+        cases = run_benchmarks(args, args.work_dir, failed)
+    else:
+        with tempfile.TemporaryDirectory() as work_dir:
+            cases = run_benchmarks(args, work_dir, failed)
+
+    report = create_report(cases, failed, args)
+    with open(args.report, "w") as file:
+        json.dump(report, file, indent = 2)
+
+    table = format_report(report) if len(cases) > 0 else "No results"
+    print(f"\n{table}\n")
+    if args.markdown != "":
+        with open(args.markdown, "w") as file:
+            file.write(table + "\n")
+
+    regressions = []
+    if args.baseline != "":
+        with open(args.baseline) as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+
+        for name, metric, old_value, value, change in regressions:
+            print(f"Regression in {name}: {metric} {format_value(metric, old_value)} -> {format_value(metric, value)} ({change:+.0%})")
+        if len(regressions) == 0:
+            print(f"No regressions against {args.baseline}")
+
+    for name, error in failed.items():
+        print(f"Failed: {name} ({error})")
+    if len(regressions) > 0 or len(failed) > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
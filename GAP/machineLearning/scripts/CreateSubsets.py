@@ -9,36 +9,171 @@
 #   1. TRAINING   - directly modifies weights
 #   2. VALIDATION - monitors generalization abilites and potential overfitting
 #   3. TESTING    - real unknown data simulation
+#
+# the classes are either the subdirectories of ORIGINAL_DIR, or (when there are
+# no subdirectories) the name prefixes of the files named by RenameData.py, e.g.
+# ladybug.12.jpg. each file is assigned to a subset by a seeded hash of its name,
+# so a file always ends up in the same subset, and re-running the script after
+# adding or removing files only adds or removes those files from the subsets.
+#
+# every split is written into SUBSET_DIR/manifest.csv (subset, class, file, source),
+# and depending on MODE the subset directories are also filled with the files.
+#
+# the corrupt images and the duplicates found by the index of ORIGINAL_DIR
+# (see DataIndex.py) are left out, so a corrupt image can't crash the training
+# and the same image can't end up in two different subsets
 
 import os
+import sys
+import csv
 import shutil
 import pathlib
+import hashlib
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+import DataIndex
 
 # source of the available dataset
 ORIGINAL_DIR = pathlib.Path(r"C:\Users\michn\Desktop\convolutions\mixed")
 # subsets output directory
 SUBSET_DIR = pathlib.Path(r"C:\Users\michn\Desktop\convolutions\mixed_subsets")
 
-# creates subsets for binary classification problems
-BINARY_CLASS_1 = "ladybug"
-BINARY_CLASS_2 = "notladybug"
-def create_subset_binary_class(subset_name, index_start, index_end):
-    for catg in (BINARY_CLASS_1, BINARY_CLASS_2):
-        dir = SUBSET_DIR / subset_name / catg
-        os.makedirs(dir)
+# subsets and the ratio of the files they get
+SUBSETS = [
+    ("train", 0.9),
+    ("validation", 0.08),
+    ("test", 0.02)
+]
 
-        f_names = [f"{catg}.{i}.jpeg" for i in range(index_start, index_end)]
-        for f_name in f_names:
-            shutil.copyfile(src = ORIGINAL_DIR / f_name, dst = dir / f_name)
+# changing the seed creates a completely different split
+SEED = 42
 
+# how the subset directories are filled:
+#   "hardlink" - the files are linked, they don't take any additional disk space
+#                (ORIGINAL_DIR and SUBSET_DIR have to be on the same drive)
+#   "symlink"  - symbolic links (on Windows, they require the developer mode)
+#   "copy"     - the files are copied
+#   "manifest" - only the manifest is written, nothing is copied or linked
+MODE = "hardlink"
 
-# GENERATE SUBSETS HERE:
+# leave out the corrupt images and the duplicates
+USE_INDEX = True
+
+MANIFEST_NAME = "manifest.csv"
+MANIFEST_FIELDS = ["subset", "class", "file", "source"]
+
+# formats supported by image_dataset_from_directory
+EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".gif"}
+
+def is_image(path):
+    return path.is_file() and path.suffix.lower() in EXTENSIONS
+
+# returns the (class, file) pairs of all images in ORIGINAL_DIR, where file
+# is the path of the image relative to the directory of its class
+def discover_files():
+    class_dirs = sorted(path for path in ORIGINAL_DIR.iterdir() if path.is_dir())
+
+    if len(class_dirs) > 0:
+        for class_dir in class_dirs:
+            for path in sorted(class_dir.rglob("*")):
+                if is_image(path):
+                    yield class_dir.name, path.relative_to(class_dir).as_posix()
+    else:
+        for path in sorted(ORIGINAL_DIR.iterdir()):
+            if is_image(path):
+                yield path.name.split(".")[0], path.name
+
+def get_source(catg, file):
+    if (ORIGINAL_DIR / catg).is_dir():
+        return ORIGINAL_DIR / catg / file
+    return ORIGINAL_DIR / file
+
+# assigns the file to a subset. the hash maps each file to a number between
+# 0 and 1, which stays the same no matter what other files are in the dataset
+def choose_subset(catg, file):
+    digest = hashlib.sha256(f"{SEED}:{catg}/{file}".encode()).digest()
+    position = int.from_bytes(digest[:8], "big") / 2 ** 64
+
+    total = sum(ratio for _, ratio in SUBSETS)
+    for subset_name, ratio in SUBSETS:
+        position -= ratio / total
+        if position < 0:
+            return subset_name
+    return SUBSETS[-1][0]
+
+def load_manifest():
+    path = SUBSET_DIR / MANIFEST_NAME
+    if not path.exists():
+        return []
+
+    with open(path, newline = "") as file:
+        return [(row["subset"], row["class"], row["file"]) for row in csv.DictReader(file)]
 
-create_subset("train", 1, 1350)
-print("subset \"train\" created")
+def save_manifest(entries):
+    os.makedirs(SUBSET_DIR, exist_ok = True)
+    path = SUBSET_DIR / MANIFEST_NAME
+    temp_path = SUBSET_DIR / f"{MANIFEST_NAME}.tmp"
 
-create_subset("validation", 1350, 1395)
-print("subset \"validation\" created")
+    with open(temp_path, "w", newline = "") as file:
+        writer = csv.writer(file)
+        writer.writerow(MANIFEST_FIELDS)
+        for subset_name, catg, file_name in sorted(entries):
+            writer.writerow([subset_name, catg, file_name, get_source(catg, file_name)])
+    os.replace(temp_path, path)
+
+def get_destination(subset_name, catg, file):
+    return SUBSET_DIR / subset_name / catg / file
+
+def add_file(subset_name, catg, file):
+    src = get_source(catg, file)
+    dst = get_destination(subset_name, catg, file)
+    if dst.exists() or dst.is_symlink():
+        return
+
+    os.makedirs(dst.parent, exist_ok = True)
+    if MODE == "hardlink":
+        os.link(src, dst)
+    elif MODE == "symlink":
+        os.symlink(src.resolve(), dst)
+    else:
+        shutil.copyfile(src = src, dst = dst)
+
+def remove_file(subset_name, catg, file):
+    dst = get_destination(subset_name, catg, file)
+    if dst.exists() or dst.is_symlink():
+        os.remove(dst)
+
+# brings the subsets up to date with ORIGINAL_DIR, only the
+# files which were added or removed since the last run are changed
+def create_subsets():
+    files = list(discover_files())
+    if USE_INDEX:
+        usable = DataIndex.get_usable(DataIndex.update_index(ORIGINAL_DIR))
+        count = len(files)
+        files = [(catg, file) for catg, file in files if get_source(catg, file).relative_to(ORIGINAL_DIR).as_posix() in usable]
+        print(f"{count - len(files)} corrupt images or duplicates left out")
+
+    entries = {(choose_subset(catg, file), catg, file) for catg, file in files}
+    previous_entries = set(load_manifest())
+
+    added, removed = entries - previous_entries, previous_entries - entries
+    if MODE != "manifest":
+        for entry in removed:
+            remove_file(*entry)
+
+        # the files which are already in the manifest are only checked, so
+        # a file deleted from a subset by hand gets linked or copied again
+        for entry in entries:
+            add_file(*entry)
+
+    save_manifest(entries)
+
+    for subset_name, _ in SUBSETS:
+        count = sum(1 for entry in entries if entry[0] == subset_name)
+        print(f"subset \"{subset_name}\" created ({count} files)")
+    print(f"{len(added)} files added, {len(removed)} files removed")
+
+
+# GENERATE SUBSETS HERE:
 
-create_subset("test", 1395, 1397)
-print("subset \"test\" created")
\ No newline at end of file
+if __name__ == "__main__":
+    create_subsets()
\ No newline at end of file
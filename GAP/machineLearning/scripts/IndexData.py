@@ -0,0 +1,46 @@
+#
+# GAP - Generative Art Producer
+#   by ZlomenyMesic & KryKom
+#
+#      founded 11.9.2024
+#
+
+# THIS SCRIPT INDEXES ALL IMAGES IN A DATASET DIRECTORY (see DataIndex.py)
+# and reports the corrupt images and the duplicates. RenameData.py, CreateSubsets.py
+# and ResizeImages.py update the index themselves, so running this script first is
+# optional, it's mostly useful to see what would be left out:
+#   python IndexData.py DIR [--distance 4] [--workers N]
+# a distance of -1 only reports the exact duplicates
+
+import sys, os, argparse
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+import DataIndex
+
+DATA_DIR = r"C:\Users\michn\Desktop\convolutions\mixed"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description = "Indexes the images of a dataset and reports the corrupt ones and the duplicates.")
+    parser.add_argument("dir", nargs = "?", default = DATA_DIR, help = "dataset directory")
+    parser.add_argument("--distance", type = int, default = DataIndex.NEAR_DUPLICATE_DISTANCE,
+                        help = "maximum number of different bits of near duplicates, -1 = only exact duplicates")
+    parser.add_argument("--workers", type = int, default = None, help = "number of processes reading the images")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    index = DataIndex.update_index(args.dir, args.workers)
+
+    corrupt = DataIndex.get_corrupt(index)
+    for relative_path, error in sorted(corrupt.items()):
+        print(f"corrupt: {relative_path} ({error})")
+
+    duplicates = DataIndex.find_duplicates(index, args.distance)
+    for relative_path, original in sorted(duplicates.items()):
+        kind = "exact" if index[relative_path]["sha256"] == index[original]["sha256"] else "near"
+        print(f"{kind} duplicate: {relative_path} of {original}")
+
+    print(f"{len(index)} images, {len(corrupt)} corrupt, {len(duplicates)} duplicates, "
+          f"{len(index) - len(corrupt) - len(duplicates)} usable")
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
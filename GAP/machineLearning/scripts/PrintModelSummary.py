@@ -5,18 +5,33 @@
 #      founded 11.9.2024
 #
 
-# disable annoying warnings
-import os
-os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+# THIS SCRIPT PRINTS THE SUMMARY OF A SAVED MODEL
+# the summary is read directly from the .keras archive (see KerasArchive.py),
+# which is done in a fraction of a second. with --full, the model is loaded
+# using keras instead, which takes much longer but also shows the output shapes
 
-import tensorflow.keras as keras
+import sys, os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+import KerasArchive
 
 MODEL_SRC = r"..\..\..\machinelearning\ladybug\cnn_model.keras"
 
-model = keras.models.load_model(MODEL_SRC)
+# the model can also be passed as the first argument
+args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+model_src = args[0] if len(args) > 0 else MODEL_SRC
 
-model.summary()
+if "--full" in sys.argv[1:]:
+    # disable annoying warnings
+    os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
-# this line doesn't work for an unknown reason
-#keras.utils.plot_model(model, "model.png")
\ No newline at end of file
+    import tensorflow.keras as keras
+
+    model = keras.models.load_model(model_src)
+
+    model.summary()
+
+    # this line doesn't work for an unknown reason
+    #keras.utils.plot_model(model, "model.png")
+else:
+    print(KerasArchive.summarize(model_src))
\ No newline at end of file
@@ -8,8 +8,16 @@
 # THIS SCRIPT IS USED TO RENAME VARIOUSY NAMED FILES USING A UNIFORM NAMING SYSTEM:
 # the new names are formatted as: class.x.extension,
 # where x represents the files order
+#
+# the files which already follow the naming system keep their names, and the new
+# files are numbered after them, so no file is ever renamed over another one.
+# the corrupt images and the duplicates (see DataIndex.py) are not renamed,
+# and when REJECTED_DIR is set, they are moved there. the files of other formats
+# than DataIndex.EXTENSIONS can't be checked, they are renamed all the same
 
-import os
+import sys, os, re, shutil
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+import DataIndex
 
 # the data is renamed, not copied!
 DATA_DIR = r"C:\Users\michn\Desktop\convolutions\mixed_subsets\train\notladybug"
@@ -17,9 +25,50 @@ DATA_DIR = r"C:\Users\michn\Desktop\convolutions\mixed_subsets\train\notladybug"
 CLASS = "ladybug"
 EXTENSION = "jpg"
 
-i = 1
-for name in os.listdir(DATA_DIR):
-	src = DATA_DIR + "\\" + name
-	dest = DATA_DIR + fr"\{CLASS}.{i}.{EXTENSION}"
-	os.rename(src, dest)
-	i += 1
\ No newline at end of file
+# directory the corrupt images and duplicates are moved to, empty = they stay where they are
+REJECTED_DIR = ""
+
+def rename_data():
+	# only the files directly in DATA_DIR are renamed, so the subdirectories aren't indexed
+	index = DataIndex.update_index(DATA_DIR, recursive = False)
+	usable = DataIndex.get_usable({name : entry for name, entry in index.items() if "/" not in name})
+
+	names = sorted(name for name in os.listdir(DATA_DIR) if os.path.isfile(os.path.join(DATA_DIR, name))
+			and name not in (DataIndex.INDEX_NAME, f"{DataIndex.INDEX_NAME}.tmp"))
+	pattern = re.compile(rf"{re.escape(CLASS)}\.(\d+)\.{re.escape(EXTENSION)}")
+	numbers = [int(match.group(1)) for match in map(pattern.fullmatch, names) if match is not None]
+
+	i = max(numbers, default = 0) + 1
+	renamed, rejected, unchecked = 0, 0, 0
+	for name in names:
+		if name in index and name not in usable:
+			rejected += 1
+			if REJECTED_DIR != "":
+				os.makedirs(REJECTED_DIR, exist_ok = True)
+				shutil.move(os.path.join(DATA_DIR, name), os.path.join(REJECTED_DIR, name))
+				del index[name]
+			continue
+
+		if pattern.fullmatch(name) is not None:
+			continue
+		if name not in index:
+			unchecked += 1
+
+		while os.path.exists(os.path.join(DATA_DIR, f"{CLASS}.{i}.{EXTENSION}")):
+			i += 1
+
+		dest = f"{CLASS}.{i}.{EXTENSION}"
+		os.rename(os.path.join(DATA_DIR, name), os.path.join(DATA_DIR, dest))
+		if name in index:
+			DataIndex.rename_entry(index, name, dest)
+		renamed += 1
+		i += 1
+
+	# the renamed files keep their entries, so they don't have to be read again
+	DataIndex.save_index(DATA_DIR, index)
+	if unchecked > 0:
+		print(f"warning: {unchecked} files of other formats than {', '.join(sorted(DataIndex.EXTENSIONS))} were renamed without being checked")
+	print(f"{renamed} files renamed, {rejected} corrupt images or duplicates {'moved to ' + REJECTED_DIR if REJECTED_DIR != '' else 'skipped'}")
+
+if __name__ == "__main__":
+	rename_data()
\ No newline at end of file
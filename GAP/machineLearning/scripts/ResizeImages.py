@@ -6,29 +6,239 @@
 #
 
 # THIS SCRIPT IS USED TO RESIZE ALL IMAGES FROM A DIRECTORY INTO A UNIFORM SIZE
+# the directory tree of SOURCE is mirrored in OUTPUT, so images with the same
+# name in different subfolders don't overwrite each other. the images are
+# resized in parallel by a pool of processes, and the images which have already
+# been resized (and haven't changed since) are skipped, so the script can be
+# re-run after adding new images or after being interrupted. the corrupt images
+# and the duplicates found by the index of SOURCE (see DataIndex.py) are skipped too.
+# the images are indexed while they are resized, so they are only read once. the
+# new images can only be compared with each other once they are all indexed, so
+# the outputs of the new duplicates are removed again at the end
 
 from PIL import Image
-import os
+import os, sys, json, pathlib, hashlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utils"))
+import DataIndex
 
 SOURCE = "dataset"
 OUTPUT = "resized"
 SIZE = (280, 210)
 
-def resize(path, name):
-    image = Image.open(path)
-    image = image.resize(SIZE)
-    image.save(fr"{OUTPUT}\{name}")
+# number of processes resizing the images, None = one per CPU core
+WORKERS = None
 
-# recursion allows searching in subfolders
-def recursive_search(dir):
-    for item in os.listdir(dir):
-        path = fr"{dir}\{item}"
-        if os.path.isfile(path):
-            resize(path, item)
-        else:
-            recursive_search(path)
+# number of images sent to a process at once, larger chunks mean less overhead
+CHUNK_SIZE = 32
 
-recursive_search(SOURCE)
+# how an already resized image is recognized as up to date:
+#   "mtime" - the output is newer than the source image
+#   "hash"  - the source image has the same content hash as when it was resized,
+#             the hashes are stored in HASHES_FILE (works even when the files
+#             get copied somewhere else and their modification times change)
+SKIP_MODE = "mtime"
+HASHES_FILE = ".hashes.json"
 
-print("done")
-input()
\ No newline at end of file
+# skip the corrupt images and the duplicates
+USE_INDEX = True
+
+# all extensions PIL can open (and save) as an image
+EXTENSIONS = Image.registered_extensions()
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# resizes a single image, and when an entry of the index is passed, adds the image to it
+def resize(source_path, output_path, entry = None):
+    with Image.open(source_path) as image:
+        size = image.size
+
+        # JPEG images can be decoded at a reduced scale (1/2, 1/4 or 1/8), which is
+        # a lot faster than decoding the full image only to shrink it afterwards.
+        # the draft is never smaller than the requested size
+        if image.format == "JPEG":
+            image.draft(image.mode, SIZE)
+        image.load()
+        if entry is not None:
+            DataIndex.add_image(entry, image, size)
+        image = image.resize(SIZE)
+
+        # the image is written under a temporary name first, so an interrupted
+        # run never leaves behind a broken image which looks up to date
+        os.makedirs(os.path.dirname(output_path), exist_ok = True)
+        temp_path = f"{output_path}.{os.getpid()}.tmp"
+        image.save(temp_path, format = EXTENSIONS[os.path.splitext(output_path)[1].lower()])
+        os.replace(temp_path, output_path)
+
+# resizes a chunk of images in a worker process. each item is a tuple of
+# (relative path, source path, output path, hash of the already resized source,
+# whether the image should be indexed). returns the relative paths with their
+# new hash (or None), status and new entry of the index (or None)
+def resize_chunk(chunk):
+    results = []
+    for relative_path, source_path, output_path, known_hash, inspect in chunk:
+        content_hash, entry = None, None
+        try:
+            if SKIP_MODE == "hash":
+                content_hash = hash_file(source_path)
+                if content_hash == known_hash and os.path.exists(output_path):
+                    results.append((relative_path, content_hash, "skipped", None))
+                    continue
+
+            if inspect:
+                entry = DataIndex.create_entry(source_path, content_hash)
+            resize(source_path, output_path, entry)
+            results.append((relative_path, content_hash, "resized", entry))
+        except Exception as e:
+            if entry is not None:
+                entry["error"] = DataIndex.format_error(e)
+            results.append((relative_path, None, f"failed: {e}", entry))
+    return results
+
+# walks the directory tree lazily, so the resizing starts right away
+# and the whole tree is never held in memory at once
+def walk(dir, relative_dir = ""):
+    with os.scandir(dir) as entries:
+        for entry in entries:
+            relative_path = os.path.join(relative_dir, entry.name)
+            if entry.is_dir():
+                yield from walk(entry.path, relative_path)
+            elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in EXTENSIONS:
+                yield relative_path, entry
+
+# yields the images which need to be resized. in the mtime mode, the up to date
+# images are left out right here, the hashes have to be compared by the workers.
+# rejected are the corrupt images and duplicates (formats the index doesn't know
+# are kept). the resized images without an up to date entry in the index are indexed
+def find_work(hashes, counts, index, rejected, seen):
+    for relative_path, entry in walk(SOURCE):
+        index_path = pathlib.PurePath(relative_path).as_posix()
+        seen.add(index_path)
+
+        known = index.get(index_path)
+        stat = entry.stat()
+        up_to_date = known is not None and known["size"] == stat.st_size and known["mtime"] == stat.st_mtime_ns
+        if up_to_date and index_path in rejected:
+            counts["rejected"] += 1
+            continue
+
+        output_path = os.path.join(OUTPUT, relative_path)
+        if SKIP_MODE == "mtime":
+            try:
+                if os.stat(output_path).st_mtime >= stat.st_mtime:
+                    counts["skipped"] += 1
+                    continue
+            except FileNotFoundError:
+                pass
+
+        inspect = USE_INDEX and not up_to_date and os.path.splitext(entry.name)[1].lower() in DataIndex.EXTENSIONS
+        yield relative_path, entry.path, output_path, hashes.get(relative_path), inspect
+
+def chunks(items):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+def load_hashes():
+    path = os.path.join(OUTPUT, HASHES_FILE)
+    if SKIP_MODE != "hash" or not os.path.exists(path):
+        return dict()
+    with open(path) as file:
+        return json.load(file)
+
+def save_hashes(hashes):
+    if SKIP_MODE != "hash":
+        return
+    os.makedirs(OUTPUT, exist_ok = True)
+    path = os.path.join(OUTPUT, HASHES_FILE)
+    with open(f"{path}.tmp", "w") as file:
+        json.dump(hashes, file)
+    os.replace(f"{path}.tmp", path)
+
+# removes the outputs of the newly indexed images which turned out to be
+# duplicates, and the entries of the images which no longer exist
+def remove_rejected(index, inspected, seen, counts):
+    for relative_path in set(index) - seen:
+        del index[relative_path]
+
+    rejected = set(index) - DataIndex.get_usable(index)
+    for relative_path in inspected & rejected:
+        output_path = os.path.join(OUTPUT, *relative_path.split("/"))
+        if os.path.exists(output_path):
+            os.remove(output_path)
+            counts["resized"] -= 1
+            counts["rejected"] += 1
+
+def resize_all():
+    hashes = load_hashes()
+    counts = {"resized" : 0, "skipped" : 0, "failed" : 0, "rejected" : 0}
+    index, rejected, inspected, seen = dict(), set(), set(), set()
+    if USE_INDEX:
+        # only the entries are loaded, the new images are indexed by the workers
+        index = DataIndex.load_index(SOURCE)
+        rejected = set(index) - DataIndex.get_usable(index)
+
+    workers = WORKERS if WORKERS is not None else os.cpu_count()
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        # only a limited number of chunks is submitted at once, the rest
+        # are taken from the directory walk as the previous ones finish
+        max_pending = 4 * workers
+        pending = set()
+        work = chunks(find_work(hashes, counts, index, rejected, seen))
+
+        try:
+            while True:
+                for chunk in work:
+                    pending.add(executor.submit(resize_chunk, chunk))
+                    if len(pending) >= max_pending:
+                        break
+
+                if len(pending) == 0:
+                    break
+
+                done, pending = wait(pending, return_when = FIRST_COMPLETED)
+                for future in done:
+                    for relative_path, content_hash, status, entry in future.result():
+                        if entry is not None:
+                            index_path = pathlib.PurePath(relative_path).as_posix()
+                            index[index_path] = entry
+                            inspected.add(index_path)
+
+                        if status.startswith("failed"):
+                            print(f"\n{relative_path} {status}")
+                            counts["failed"] += 1
+                            continue
+
+                        counts[status] += 1
+                        if content_hash is not None:
+                            hashes[relative_path] = content_hash
+
+                print(f"resized: {counts['resized']}, skipped: {counts['skipped']}, failed: {counts['failed']}, rejected: {counts['rejected']}", end = "\r")
+
+            if USE_INDEX:
+                remove_rejected(index, inspected, seen, counts)
+        finally:
+            # the hashes and entries of the finished images are kept even if the run is interrupted
+            save_hashes(hashes)
+            if USE_INDEX:
+                DataIndex.save_index(SOURCE, index)
+
+    print()
+    return counts
+
+if __name__ == "__main__":
+    resize_all()
+
+    print("done")
+    if sys.stdin.isatty():
+        input()
\ No newline at end of file
@@ -14,6 +14,8 @@ internal static class Scripts {
     private const string CREATE_SUBSETS_PATH = @"scripts\CreateSubsets.py";
     private const string RESIZE_IMAGES_PATH = @"scripts\ResizeImages.py";
     private const string PRINT_MODEL_SUMMARY_PATH = @"scripts\PrintModelSummary.py";
+    private const string BENCHMARK_PATH = @"scripts\Benchmark.py";
+    private const string INDEX_DATA_PATH = @"scripts\IndexData.py";
 
     internal static void RenameData() {
         PythonWrapper.RunPythonScript(RENAME_DATA_PATH);
@@ -30,4 +32,12 @@ internal static class Scripts {
     internal static void PrintModelSummary() {
         PythonWrapper.RunPythonScript(PRINT_MODEL_SUMMARY_PATH);
     }
+
+    internal static void RunBenchmark(string args = "") {
+        PythonWrapper.RunPythonScript(BENCHMARK_PATH, args);
+    }
+
+    internal static void RunIndexData(string args = "") {
+        PythonWrapper.RunPythonScript(INDEX_DATA_PATH, args);
+    }
 }
@@ -10,14 +10,22 @@
 #sys.path.append(os.path.relpath(r"..\..\..\machinelearning\utils"))
 #from ConsoleColors import *
 
-WHITE = "\033[0;37;40m"
-GRAY = "\033[1;30;40m"
-RED = "\033[1;31;40m"
-GREEN = "\033[1;32;40m"
-YELLOW = "\033[1;33;40m"
-BLUE = "\033[1;34;40m"
-MAGENTA = "\033[1;35;40m"
-CYAN = "\033[0;36;40m"
+import sys, os
+
+# the colors are only used when writing to a console. when the output is redirected
+# (e.g. read by PythonWrapper or written into a log), the escape codes would only
+# end up as garbage in the text. NO_COLOR disables the colors even in a console,
+# GAP_PROGRESS=tty (see Progress.py) forces them even when redirected
+USE_COLORS = (sys.stdout.isatty() and "NO_COLOR" not in os.environ) or os.environ.get("GAP_PROGRESS") == "tty"
+
+WHITE = "\033[0;37;40m" if USE_COLORS else ""
+GRAY = "\033[1;30;40m" if USE_COLORS else ""
+RED = "\033[1;31;40m" if USE_COLORS else ""
+GREEN = "\033[1;32;40m" if USE_COLORS else ""
+YELLOW = "\033[1;33;40m" if USE_COLORS else ""
+BLUE = "\033[1;34;40m" if USE_COLORS else ""
+MAGENTA = "\033[1;35;40m" if USE_COLORS else ""
+CYAN = "\033[0;36;40m" if USE_COLORS else ""
 
 BULLET = "\u25cf"
 CIRCLE = "\u25cb"
\ No newline at end of file
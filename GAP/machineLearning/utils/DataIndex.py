@@ -0,0 +1,215 @@
+#
+# GAP - Generative Art Producer
+#   by ZlomenyMesic & KryKom
+#
+#      founded 11.9.2024
+#
+
+# INDEX OF THE IMAGES IN A DATASET DIRECTORY:
+# every image is read once and the index (INDEX_NAME, stored in the directory
+# itself) records its:
+#   sha256 - hash of the content, equal for exact duplicates
+#   dhash  - perceptual hash, similar for images which only differ in size,
+#            compression or slight edits (near duplicates)
+#   width, height
+#   error  - why the image can't be decoded, empty for valid images
+# the size and modification time of each file are kept as well, so the next
+# update only reads the files which were added or changed since.
+#
+# the data preparation scripts use the index to leave out the corrupt images
+# (which would otherwise crash the training in the middle of an epoch) and the
+# duplicates (which make the epochs longer and leak between the subsets)
+#
+# usage:
+#   index = DataIndex.update_index(dir)   - indexes the new and changed files
+#   usable = DataIndex.get_usable(index)  - valid images without duplicates
+
+# HOW TO IMPORT THE DATA INDEX
+#import sys, os
+#sys.path.append(os.path.relpath(r"..\..\..\machinelearning\utils"))
+#import DataIndex
+
+import os, json, hashlib
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+
+INDEX_NAME = ".index.json"
+
+# changes whenever the content of the entries changes, older indices are rebuilt
+INDEX_VERSION = 1
+
+# formats supported by image_dataset_from_directory
+EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".gif"}
+
+# maximum number of different bits of the perceptual hashes of near duplicates (out of 64)
+NEAR_DUPLICATE_DISTANCE = 4
+
+# number of files sent to a process at once
+CHUNK_SIZE = 32
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# difference hash: the image is shrunk to 9x8 pixels in grayscale, and each
+# bit says whether a pixel is brighter than its right neighbour
+def calculate_dhash(image):
+    pixels = list(image.convert("L").resize((9, 8), Image.BILINEAR).getdata())
+    bits = 0
+    for row in range(8):
+        for column in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + column] > pixels[row * 9 + column + 1])
+    return f"{bits:016x}"
+
+# the entry of a file before its image is decoded (see add_image). the hash can
+# be passed when the caller has already calculated it
+def create_entry(path, sha256 = None):
+    stat = os.stat(path)
+    return {"size" : stat.st_size, "mtime" : stat.st_mtime_ns, "sha256" : sha256 if sha256 is not None else hash_file(path),
+            "dhash" : "", "width" : 0, "height" : 0, "error" : ""}
+
+# adds the decoded image to its entry. the size is passed separately, because
+# the image may have been decoded at a reduced scale (see Image.draft), which
+# changes its perceptual hash by a bit or two at most
+def add_image(entry, image, size):
+    entry["width"], entry["height"] = size
+    entry["dhash"] = calculate_dhash(image)
+
+def format_error(e):
+    return f"{type(e).__name__}: {e}" if str(e) != "" else type(e).__name__
+
+# reads a single image, the whole image is decoded, so even truncated images are found
+def inspect_file(path):
+    entry = create_entry(path)
+    try:
+        with Image.open(path) as image:
+            image.load()
+            add_image(entry, image, image.size)
+    except Exception as e:
+        entry["error"] = format_error(e)
+    return entry
+
+def inspect_chunk(chunk):
+    return [(relative_path, inspect_file(path)) for relative_path, path in chunk]
+
+def load_index(dir):
+    path = os.path.join(dir, INDEX_NAME)
+    if not os.path.exists(path):
+        return dict()
+
+    with open(path) as file:
+        content = json.load(file)
+    return content["files"] if content.get("version") == INDEX_VERSION else dict()
+
+def save_index(dir, index):
+    path = os.path.join(dir, INDEX_NAME)
+    with open(f"{path}.tmp", "w") as file:
+        json.dump({"version" : INDEX_VERSION, "files" : index}, file, separators = (",", ":"))
+    os.replace(f"{path}.tmp", path)
+
+# returns the paths of all images in the directory tree (or only directly in the
+# directory), relative to it and always separated by forward slashes (the keys of the index)
+def list_images(dir, recursive = True, relative_dir = ""):
+    with os.scandir(dir) as entries:
+        for entry in sorted(entries, key = lambda entry: entry.name):
+            relative_path = f"{relative_dir}{entry.name}"
+            if entry.is_dir():
+                if recursive:
+                    yield from list_images(entry.path, recursive, f"{relative_path}/")
+            elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in EXTENSIONS:
+                yield relative_path, entry
+
+# brings the index of the directory up to date and returns it. only the new and
+# changed files are read (in parallel), the entries of deleted files are removed.
+# when not recursive, only the files directly in the directory are updated, the
+# entries of the subdirectories are kept as they are
+def update_index(dir, workers = None, verbose = True, recursive = True):
+    index = load_index(dir)
+    updated = dict()
+    if not recursive:
+        updated = {relative_path : entry for relative_path, entry in index.items() if "/" in relative_path}
+
+    work = []
+    for relative_path, entry in list_images(dir, recursive):
+        stat = entry.stat()
+        known = index.get(relative_path)
+        if known is not None and known["size"] == stat.st_size and known["mtime"] == stat.st_mtime_ns:
+            updated[relative_path] = known
+        else:
+            work.append((relative_path, entry.path))
+
+    if len(work) > 0:
+        chunks = [work[i : i + CHUNK_SIZE] for i in range(0, len(work), CHUNK_SIZE)]
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            for results in executor.map(inspect_chunk, chunks):
+                updated.update(results)
+                if verbose:
+                    print(f"indexed: {len(updated)}, new or changed: {len(work)}", end = "\r")
+        if verbose:
+            print()
+
+    if len(work) > 0 or len(updated) != len(index):
+        save_index(dir, updated)
+    return updated
+
+# moves an entry after its file was renamed, so the file doesn't have to be read again
+def rename_entry(index, relative_path, new_relative_path):
+    index[new_relative_path] = index.pop(relative_path)
+
+def count_bits(value):
+    return bin(value).count("1")
+
+# returns the duplicates of other images as a dictionary of {duplicate : original}.
+# the first image in the sorted order is kept as the original. near duplicates are
+# found by splitting the hashes into max_distance + 1 parts, any two hashes which
+# differ in at most max_distance bits then have at least one part the same, so
+# only the images sharing a part have to be compared
+def find_duplicates(index, max_distance = NEAR_DUPLICATE_DISTANCE):
+    duplicates = dict()
+    originals = dict()
+    for relative_path in sorted(index):
+        entry = index[relative_path]
+        if entry["error"] != "":
+            continue
+        if entry["sha256"] in originals:
+            duplicates[relative_path] = originals[entry["sha256"]]
+        else:
+            originals[entry["sha256"]] = relative_path
+
+    if max_distance < 0:
+        return duplicates
+
+    parts = max_distance + 1
+    bounds = [(64 * i // parts, 64 * (i + 1) // parts) for i in range(parts)]
+    buckets = [dict() for _ in range(parts)]
+    for relative_path in sorted(originals.values()):
+        value = int(index[relative_path]["dhash"], 16)
+        original = None
+        for bucket, (start, end) in zip(buckets, bounds):
+            part = (value >> start) & ((1 << (end - start)) - 1)
+            for candidate, candidate_value in bucket.get(part, []):
+                if count_bits(value ^ candidate_value) <= max_distance:
+                    original = candidate
+                    break
+            if original is not None:
+                break
+
+        if original is not None:
+            duplicates[relative_path] = original
+            continue
+
+        for bucket, (start, end) in zip(buckets, bounds):
+            part = (value >> start) & ((1 << (end - start)) - 1)
+            bucket.setdefault(part, []).append((relative_path, value))
+    return duplicates
+
+def get_corrupt(index):
+    return {relative_path : entry["error"] for relative_path, entry in index.items() if entry["error"] != ""}
+
+# returns the paths of the valid images which aren't duplicates of other images
+def get_usable(index, max_distance = NEAR_DUPLICATE_DISTANCE):
+    duplicates = find_duplicates(index, max_distance)
+    return {relative_path for relative_path, entry in index.items() if entry["error"] == "" and relative_path not in duplicates}
\ No newline at end of file
@@ -0,0 +1,207 @@
+#
+# GAP - Generative Art Producer
+#   by ZlomenyMesic & KryKom
+#
+#      founded 11.9.2024
+#
+
+# CONTENT-ADDRESSED CACHE FOR INPUT IMAGES AND THEIR PREPROCESSED VERSIONS:
+# downloaded images are stored under the hash of their content and the URLs
+# are remembered, so an image is only downloaded once. preprocessed images are
+# stored as .npy files keyed by the hash of the source image and the name of
+# the preprocessing, and are loaded back memory-mapped. when the cache grows
+# over its maximum size, the least recently used files are removed
+#
+# cache directory layout:
+#   sources/<hash><extension>   - downloaded images
+#   arrays/<hash>.npy           - preprocessed images
+#   index.json                  - URLs and local files with their content hashes
+#
+# the cache may be shared by several processes at once (e.g. the workers of
+# DreamScheduler.py), so the index is merged with the entries saved by the
+# other processes whenever it's saved, while holding a lock file
+
+import os, json, time, shutil, hashlib, contextlib, urllib.request, urllib.parse
+import numpy as np
+
+CACHE_DIR = ""
+CACHE_SIZE = 1024 * 1024 * 1024
+
+# directory used in place of the network. when set, an image downloaded
+# from a URL is looked up in this directory by its name instead
+ORIGIN_MIRROR = ""
+
+index = None
+
+# sets up the cache, an empty cache directory disables the cache
+def configure(cache_dir, cache_size_mb = 1024, origin_mirror = ""):
+    global CACHE_DIR, CACHE_SIZE, ORIGIN_MIRROR, index
+    if cache_dir != CACHE_DIR:
+        index = None
+
+    CACHE_DIR = cache_dir
+    CACHE_SIZE = cache_size_mb * 1024 * 1024
+    ORIGIN_MIRROR = origin_mirror
+
+def is_enabled():
+    return CACHE_DIR != ""
+
+def load_index():
+    global index
+    if index is None:
+        index = {"urls" : {}, "files" : {}}
+        index_path = os.path.join(CACHE_DIR, "index.json")
+        if os.path.exists(index_path):
+            with open(index_path) as file:
+                index.update(json.load(file))
+    return index
+
+# a lock left behind by a killed process is removed once it's older than this (in seconds)
+LOCK_TIMEOUT = 10
+
+# holds the lock file of the index, so only one process saves it at a time
+@contextlib.contextmanager
+def lock_index():
+    lock_path = os.path.join(CACHE_DIR, "index.json.lock")
+    while True:
+        try:
+            lock = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.stat(lock_path).st_mtime > LOCK_TIMEOUT:
+                    os.remove(lock_path)
+            except OSError:
+                pass
+            time.sleep(0.01)
+
+    try:
+        yield
+    finally:
+        os.close(lock)
+        os.remove(lock_path)
+
+# the entries saved by other processes since the index was loaded are merged
+# into it first, so no process overwrites the entries of another. the index is
+# replaced at once, so other processes never read a half-written file
+def save_index():
+    os.makedirs(CACHE_DIR, exist_ok = True)
+    index_path = os.path.join(CACHE_DIR, "index.json")
+    with lock_index():
+        if os.path.exists(index_path):
+            with open(index_path) as file:
+                saved = json.load(file)
+            for name in ("urls", "files"):
+                index[name] = {**saved.get(name, dict()), **index[name]}
+
+        temp_path = os.path.join(CACHE_DIR, f"index.json.{os.getpid()}.tmp")
+        with open(temp_path, "w") as file:
+            json.dump(index, file)
+        os.replace(temp_path, index_path)
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# returns the content hash of a local file. the hash is remembered along with
+# the size and modification time of the file, so it's only calculated again
+# when the file changes
+def get_file_hash(path):
+    files = load_index()["files"]
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+
+    entry = files.get(path)
+    if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+        return entry[2]
+
+    content_hash = hash_file(path)
+    files[path] = [stat.st_size, stat.st_mtime_ns, content_hash]
+    save_index()
+    return content_hash
+
+# marks a cached file as recently used
+def touch(path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+# returns the local path of an image from a URL, it's only downloaded when
+# it isn't cached yet (or taken from ORIGIN_MIRROR when it is set)
+def fetch(name, origin):
+    urls = load_index()["urls"]
+    sources_dir = os.path.join(CACHE_DIR, "sources")
+
+    if origin in urls:
+        path = os.path.join(sources_dir, urls[origin])
+        if os.path.exists(path):
+            touch(path)
+            return path
+
+    os.makedirs(sources_dir, exist_ok = True)
+    if name is None or name == "":
+        name = os.path.basename(urllib.parse.urlparse(origin).path)
+    temp_path = os.path.join(sources_dir, f"{os.getpid()}.download")
+
+    if ORIGIN_MIRROR != "":
+        shutil.copyfile(os.path.join(ORIGIN_MIRROR, name), temp_path)
+    else:
+        with urllib.request.urlopen(origin) as response, open(temp_path, "wb") as file:
+            shutil.copyfileobj(response, file)
+
+    # the extension is kept, so the image format can still be recognized
+    file_name = hash_file(temp_path) + os.path.splitext(name)[1]
+    path = os.path.join(sources_dir, file_name)
+    os.replace(temp_path, path)
+
+    urls[origin] = file_name
+    save_index()
+    evict()
+    return path
+
+# returns the preprocessed image, either loaded (memory-mapped) from the cache
+# or created by the preprocess function and then cached. the preprocessing name
+# has to change whenever the preprocessing itself changes
+def load_array(path, preprocessing, preprocess):
+    key = hashlib.sha256(f"{get_file_hash(path)}:{preprocessing}".encode()).hexdigest()
+    array_path = os.path.join(CACHE_DIR, "arrays", f"{key}.npy")
+
+    if os.path.exists(array_path):
+        touch(array_path)
+        return np.load(array_path, mmap_mode = "r")
+
+    array = preprocess(path)
+
+    os.makedirs(os.path.dirname(array_path), exist_ok = True)
+    temp_path = f"{array_path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as file:
+        np.save(file, array)
+    os.replace(temp_path, array_path)
+
+    evict()
+    return array
+
+# removes the least recently used files until the cache fits into CACHE_SIZE
+def evict():
+    files = []
+    for directory in ("sources", "arrays"):
+        directory = os.path.join(CACHE_DIR, directory)
+        if os.path.isdir(directory):
+            for entry in os.scandir(directory):
+                if entry.is_file():
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_size = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total_size <= CACHE_SIZE:
+            break
+        try:
+            os.remove(path)
+            total_size -= size
+        except OSError:
+            pass
\ No newline at end of file
@@ -0,0 +1,116 @@
+#
+# GAP - Generative Art Producer
+#   by ZlomenyMesic & KryKom
+#
+#      founded 11.9.2024
+#
+
+# FAST INSPECTION OF SAVED .keras MODELS:
+# a .keras file is a zip archive containing config.json (the architecture),
+# metadata.json (keras version, date saved) and model.weights.h5 (the weights).
+# reading the config directly takes milliseconds, while loading the model
+# takes seconds just to import tensorflow, and then builds the whole graph
+# and loads all the weights. the number of weights of each layer is read from
+# the weights file when h5py is installed, without loading the weights themselves
+
+# HOW TO IMPORT THE KERAS ARCHIVE
+#import sys, os
+#sys.path.append(os.path.relpath(r"..\..\..\machinelearning\utils"))
+#import KerasArchive
+
+import json, zipfile
+
+def read_json(path, name):
+    with zipfile.ZipFile(path) as archive:
+        return json.loads(archive.read(name))
+
+def read_config(path):
+    return read_json(path, "config.json")
+
+# older archives may not contain the metadata
+def read_metadata(path):
+    try:
+        return read_json(path, "metadata.json")
+    except KeyError:
+        return dict()
+
+# returns the layers as (name, class name, layer config) tuples
+def get_layers(config):
+    layers = []
+    for layer in config["config"]["layers"]:
+        layer_config = layer.get("config", dict())
+        layers.append((layer_config.get("name", layer.get("name")), layer["class_name"], layer_config))
+    return layers
+
+# returns the input shape of the model including the batch dimension (e.g. [None, 180, 180, 3])
+def get_input_shape(config):
+    for _, class_name, layer_config in get_layers(config):
+        if class_name == "InputLayer":
+            return layer_config.get("batch_shape", layer_config.get("batch_input_shape"))
+    return config.get("build_config", dict()).get("input_shape")
+
+# returns a short description of the layer, e.g. "32 filters 3x3, relu"
+def describe_layer(class_name, layer_config):
+    details = []
+    if "units" in layer_config:
+        details.append(f"{layer_config['units']} units")
+    if "filters" in layer_config:
+        details.append(f"{layer_config['filters']} filters")
+    for name in ("kernel_size", "pool_size"):
+        if isinstance(layer_config.get(name), (list, tuple)):
+            details.append("x".join(str(size) for size in layer_config[name]))
+    if "rate" in layer_config:
+        details.append(f"rate {layer_config['rate']}")
+    if "batch_shape" in layer_config:
+        details.append(f"shape {layer_config['batch_shape']}")
+
+    activation = layer_config.get("activation")
+    if isinstance(activation, str) and activation != "linear":
+        details.append(activation)
+    return ", ".join(details)
+
+# returns the number of weights of each layer by its name, or None when h5py isn't installed
+def count_weights(path):
+    try:
+        import h5py
+    except ImportError:
+        return None
+
+    counts = dict()
+    def visit(name, item):
+        parts = name.split("/")
+        if isinstance(item, h5py.Dataset) and parts[0] == "layers" and len(parts) > 1:
+            counts[parts[1]] = counts.get(parts[1], 0) + item.size
+
+    with zipfile.ZipFile(path) as archive, archive.open("model.weights.h5") as file:
+        with h5py.File(file, "r") as weights:
+            weights.visititems(visit)
+    return counts
+
+# the summary of the model as text, similar to model.summary()
+def summarize(path):
+    config = read_config(path)
+    metadata = read_metadata(path)
+    counts = count_weights(path)
+
+    rows = [("Layer", "Type", "Details", "Weights")]
+    for name, class_name, layer_config in get_layers(config):
+        weights = "?" if counts is None else str(counts.get(name, 0))
+        rows.append((name, class_name, describe_layer(class_name, layer_config), weights))
+
+    widths = [max(len(row[i]) for row in rows) for i in range(4)]
+    lines = [f"Model: {config['config'].get('name', '')} ({config['class_name']})"]
+    if "keras_version" in metadata:
+        lines.append(f"Saved by keras {metadata['keras_version']} on {metadata.get('date_saved', '?')}")
+    lines.append(f"Input shape: {get_input_shape(config)}\n")
+
+    for i, row in enumerate(rows):
+        lines.append("  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+        if i == 0:
+            lines.append("-" * (sum(widths) + 2 * (len(widths) - 1)))
+
+    if counts is not None:
+        lines.append(f"\nTotal weights: {sum(counts.values())}")
+    else:
+        lines.append(f"\nInstall h5py to count the weights of each layer")
+    return "\n".join(lines)
\ No newline at end of file
@@ -0,0 +1,79 @@
+#
+# GAP - Generative Art Producer
+#   by ZlomenyMesic & KryKom
+#
+#      founded 11.9.2024
+#
+
+# MESSAGE PROTOCOL USED BETWEEN THE C# HOST AND THE PYTHON SCRIPTS:
+# every message is a single line containing a JSON object with a "type" field
+#
+# the host sends (to stdin of the script):
+#   {"type": "job", "id": "1", "params": {...}}    - typed job parameters
+#   {"type": "cancel", "id": "1"}                  - cancel the job (DreamScheduler.py only)
+#   {"type": "exit"}                               - stop the script
+#
+# the script sends (to its stdout):
+#   {"type": "ready"}                              - the script is ready to receive jobs
+#   {"type": "progress", "id": "1", ...}           - e.g. layer, octave, iteration, loss
+#   {"type": "preview", "id": "1", "paths": [...]} - a preview of the images was saved
+#   {"type": "result", "id": "1", ...}             - the job finished successfully
+#   {"type": "error", "id": "1", "message": ...}   - the job failed
+#   {"type": "cancelled", "id": "1"}               - the job was cancelled
+#
+# the host also treats the end of the stream as an error, so a crashed script
+# never leaves it waiting. because stdout carries the messages, everything
+# else the script prints is redirected to stderr while the protocol is used
+
+# HOW TO IMPORT THE MESSAGE PROTOCOL
+#import sys, os
+#sys.path.append(os.path.relpath(r"..\..\..\machinelearning\utils"))
+#import MessageProtocol
+
+import sys, json, threading, traceback
+
+# the original stdout, the messages are only written here
+message_stream = None
+message_lock = threading.Lock()
+
+# switches the script into the protocol mode. an uncaught exception
+# is reported to the host as an error message before the script exits
+def start():
+    global message_stream
+    message_stream = sys.stdout
+    sys.stdout = sys.stderr
+
+    original_hook = sys.excepthook
+    def report_exception(exc_type, exc_value, exc_traceback):
+        send_error(None, exc_value)
+        original_hook(exc_type, exc_value, exc_traceback)
+    sys.excepthook = report_exception
+
+def is_active():
+    return message_stream is not None
+
+# sends a single message, does nothing if the protocol isn't used
+def send(message_type, **fields):
+    if message_stream is None:
+        return
+
+    line = json.dumps({"type" : message_type, **fields})
+    with message_lock:
+        message_stream.write(line + "\n")
+        message_stream.flush()
+
+# reports a failed job (or the whole script failing when the id is None)
+def send_error(id, exception):
+    send("error", id = id, message = f"{type(exception).__name__}: {exception}",
+         traceback = "".join(traceback.format_exception(type(exception), exception, exception.__traceback__)))
+
+# yields the messages sent by the host until the end of the input stream
+def receive():
+    for line in sys.stdin:
+        if line.strip() == "":
+            continue
+
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError as e:
+            send("error", message = f"invalid message: {e}")
\ No newline at end of file
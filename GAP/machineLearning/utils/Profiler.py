@@ -0,0 +1,123 @@
+#
+# GAP - Generative Art Producer
+#   by ZlomenyMesic & KryKom
+#
+#      founded 11.9.2024
+#
+
+# PER-PHASE TIMING AND PROFILING:
+# each finished phase is written as a single line of JSON containing its wall
+# and CPU time, the memory used by the process and any additional fields, e.g.
+#   {"event": "phase", "name": "octave", "wall": 1.52, "cpu": 5.87, "memory": 912261120,
+#    "peak_memory": 1044381696, "octave": 3, "iterations": 5, "iterations_per_second": 3.29}
+#
+# usage:
+#   Profiler.configure("profile.jsonl")    - "-" writes to stderr, "" disables profiling
+#   with Profiler.phase("octave", octave = 3) as fields:
+#       ...
+#       fields["iterations"] = 5           - fields can also be added inside the phase
+#   with Profiler.trace("logs"):           - TensorFlow profiler trace (TensorBoard)
+#       ...
+
+# HOW TO IMPORT THE PROFILER
+#import sys, os
+#sys.path.append(os.path.relpath(r"..\..\..\machinelearning\utils"))
+#import Profiler
+
+import sys, os, json, time, threading
+from contextlib import contextmanager
+
+PROFILE_PATH = ""
+
+output = None
+output_lock = threading.Lock()
+
+def configure(path):
+    global PROFILE_PATH, output
+    if path == PROFILE_PATH:
+        return
+
+    if output is not None and output is not sys.stderr:
+        output.close()
+
+    PROFILE_PATH = path
+    output = None
+    if path == "-":
+        output = sys.stderr
+    elif path != "":
+        output = open(path, "a")
+
+def is_enabled():
+    return output is not None
+
+# returns the current and the peak memory used by the process in bytes
+# (None when it can't be determined on the current platform)
+def memory_usage():
+    current, peak = None, None
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        # the peak is only reported on Windows
+        current, peak = info.rss, getattr(info, "peak_wset", None)
+    except ImportError:
+        pass
+
+    if peak is None:
+        try:
+            import resource
+            # kilobytes on linux, bytes on macOS
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            peak *= 1 if sys.platform == "darwin" else 1024
+        except ImportError:
+            pass
+
+    if current is None:
+        try:
+            with open("/proc/self/statm") as file:
+                current = int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, AttributeError):
+            pass
+    return current, peak
+
+# writes a single event, does nothing when profiling is disabled
+def emit(event, **fields):
+    if output is None:
+        return
+
+    line = json.dumps({"event" : event, "time" : time.time(), **fields})
+    with output_lock:
+        output.write(line + "\n")
+        output.flush()
+
+# measures a single phase, the yielded dictionary can be used to add fields
+# (an "iterations" field also adds the number of iterations per second).
+# the record is written even when the phase raises an exception
+@contextmanager
+def phase(name, /, **fields):
+    if output is None:
+        yield fields
+        return
+
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield fields
+    finally:
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        if "iterations" in fields and wall > 0:
+            fields["iterations_per_second"] = fields["iterations"] / wall
+
+        # the measured values take precedence over fields of the same name
+        memory, peak_memory = memory_usage()
+        emit("phase", **{**fields, "name" : name, "wall" : wall, "cpu" : cpu, "memory" : memory, "peak_memory" : peak_memory})
+
+# captures a TensorFlow profiler trace into the given directory
+@contextmanager
+def trace(logdir):
+    import tensorflow as tf
+
+    tf.profiler.experimental.start(logdir)
+    try:
+        yield
+    finally:
+        tf.profiler.experimental.stop()
+        emit("trace", logdir = logdir)
\ No newline at end of file
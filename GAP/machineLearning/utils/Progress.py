@@ -0,0 +1,123 @@
+#
+# GAP - Generative Art Producer
+#   by ZlomenyMesic & KryKom
+#
+#      founded 11.9.2024
+#
+
+# THROTTLED PROGRESS OUTPUT:
+# writing to the console on every iteration slows the loop down, especially when
+# the output is redirected to a pipe. here, the loop only stores the latest state,
+# and a background thread writes it at most once per INTERVAL. the output is
+# written in one of three modes:
+#   "tty"   - a single line rewritten in place (when writing to a console)
+#   "plain" - plain text lines without colors (when redirected, e.g. to a log)
+#   "json"  - a JSON object per line, for other programs reading the output
+# the mode is detected automatically, or set by the GAP_PROGRESS environment variable
+#
+# usage:
+#   Progress.update(f"Octave {i}", octave = i, loss = loss)   - only the latest update is written
+#   Progress.log(f"Layer {name} finished", layer = name)      - always written, in order
+#   Progress.stop()                                           - writes everything left
+
+# HOW TO IMPORT THE PROGRESS
+#import sys, os
+#sys.path.append(os.path.relpath(r"..\..\..\machinelearning\utils"))
+#import Progress
+
+import sys, os, re, json, time, queue, atexit, threading
+
+# minimum time between two written updates in seconds
+INTERVAL = {"tty" : 0.1, "plain" : 2.0, "json" : 1.0}
+
+ANSI_CODES = re.compile(r"\033\[[0-9;]*[A-Za-z]")
+
+mode = None
+messages = queue.Queue()
+latest_update = None
+writer = None
+writer_lock = threading.Lock()
+
+def detect_mode(stream):
+    requested = os.environ.get("GAP_PROGRESS", "")
+    if requested in INTERVAL:
+        return requested
+    return "tty" if stream.isatty() else "plain"
+
+# starts the background writer, called automatically by the first update or log
+def start(requested_mode = None):
+    global mode, writer
+    with writer_lock:
+        if writer is not None:
+            return
+        mode = requested_mode or detect_mode(sys.stdout)
+        writer = threading.Thread(target = write_messages, daemon = True)
+        writer.start()
+
+# replaces the pending update, never blocks
+def update(text, **fields):
+    global latest_update
+    if writer is None:
+        start()
+    latest_update = (text, fields)
+
+# a message which is always written, after the updates before it
+def log(text = "", **fields):
+    if writer is None:
+        start()
+    messages.put((text, fields))
+
+# writes all the remaining messages and stops the writer
+def stop():
+    global writer, latest_update
+    with writer_lock:
+        if writer is None:
+            return
+        messages.put(None)
+        writer.join()
+        writer = None
+        latest_update = None
+
+# the remaining messages are also written when the script simply ends
+atexit.register(stop)
+
+def format_message(text, fields, is_update):
+    if mode == "json":
+        return json.dumps({"event" : "progress" if is_update else "log", "text" : ANSI_CODES.sub("", text), **fields}) + "\n"
+    if mode == "plain":
+        return ANSI_CODES.sub("", text) + "\n"
+    # in a console, the update line is rewritten in place, while a logged line first
+    # clears the current update and then stays above the next one
+    if is_update:
+        return f"\r{text}\033[K"
+    return f"\r\033[K{text}\n"
+
+def write_messages():
+    written_update, last_write = None, 0.0
+    while True:
+        try:
+            message = messages.get(timeout = INTERVAL[mode])
+        except queue.Empty:
+            message = False
+
+        if message:
+            sys.stdout.write(format_message(*message, False))
+            # in a console, the logged line has replaced the update, so it's written again below
+            if mode == "tty":
+                written_update = None
+
+        # the latest update is written once enough time has passed since the last one,
+        # or right away when it has to be redrawn or when it's the very last one
+        update = latest_update
+        now = time.monotonic()
+        if update is not None and update is not written_update:
+            if now - last_write >= INTERVAL[mode] or message is None or (message and mode == "tty"):
+                sys.stdout.write(format_message(*update, True))
+                written_update, last_write = update, now
+
+        if message is None:
+            if mode == "tty" and written_update is not None:
+                sys.stdout.write("\n")
+            sys.stdout.flush()
+            return
+        sys.stdout.flush()
\ No newline at end of file